@@ -1,6 +1,46 @@
 import configparser
+import re
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, table_layouts
+
+
+def layout_clause(table, layout, query):
+    """
+    Renders the distribution and sort keys of a table layout as the clause that ends its CREATE TABLE.
+    :param table: name of the table
+    :param layout: dict with the optional keys diststyle (EVEN, KEY, ALL or AUTO, KEY if distkey is given),
+                   distkey (column) and sortkey (list of columns)
+    :param query: CREATE TABLE query of the table, used to check the columns of the layout
+    :return: string such as 'DISTSTYLE KEY DISTKEY("song_id") SORTKEY("start_time")'
+    """
+    distkey = layout.get('distkey')
+    diststyle = layout.get('diststyle', 'KEY' if distkey else 'AUTO').upper()
+    if (diststyle == 'KEY') != bool(distkey):
+        raise ValueError('Layout of {}: DISTSTYLE KEY requires a distkey and only it accepts one'.format(table))
+
+    columns = ([distkey] if distkey else []) + layout.get('sortkey', [])
+    for column in columns:
+        if '"{}"'.format(column) not in query:
+            raise ValueError('Layout of {}: unknown column {}'.format(table, column))
+
+    clause = 'DISTSTYLE {}'.format(diststyle)
+    if distkey:
+        clause += ' DISTKEY("{}")'.format(distkey)
+    if layout.get('sortkey'):
+        clause += ' SORTKEY({})'.format(', '.join('"{}"'.format(c) for c in layout['sortkey']))
+    return clause
+
+
+def render_layout(query):
+    """
+    Adds the layout of table_layouts to a CREATE TABLE query.
+    :param query: CREATE TABLE query
+    :return: query with the distribution and sort keys of its table (unchanged if the table has no layout)
+    """
+    table = re.search(r'CREATE TABLE "(\w+)"', query).group(1)
+    if table not in table_layouts:
+        return query
+    return query.rstrip() + '\n' + layout_clause(table, table_layouts[table], query) + '\n'
 
 
 def drop_tables(cur, conn):
@@ -17,13 +57,13 @@ def drop_tables(cur, conn):
 
 def create_tables(cur, conn):
     """
-    Creates all Redshift tables in this project.
+    Creates all Redshift tables in this project, with the distribution and sort keys of table_layouts.
     :param cur: psycopg2 cursor
     :param conn: psycopg2 connection
     :return:
     """
     for query in create_table_queries:
-        cur.execute(query)
+        cur.execute(render_layout(query))
         conn.commit()
 
 
@@ -46,4 +86,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,41 +1,296 @@
+import argparse
 import configparser
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from psycopg2.pool import ThreadedConnectionPool
+from sql_queries import copy_table_queries, insert_table_steps, load_errors_select
+from sql_queries import event_dimension_upserts, song_dimension_upserts, songplay_table_upsert
+from sql_queries import truncate_staging_queries
 
+# maximum number of connections opened to Redshift at the same time
+MAX_CONNECTIONS = 4
+# maximum number of stl_load_errors rows printed for each COPY
+MAX_LOAD_ERRORS = 10
 
-def load_staging_tables(cur, conn):
+
+def copy_target(query):
     """
-    Loads events and songs data from S3 to Redshift (staging tables)
-    :param cur: psycopg2 cursor
-    :param conn: psycopg2 connection
-    :return: None
+    Finds the table loaded by a COPY query.
+    :param query: COPY query
+    :return: name of the table
     """
-    print('Loading staging tables...')
-    for query in copy_table_queries:
-        cur.execute(query)
+    return query.split()[1]
+
+
+def run_copy(pool, query):
+    """
+    Runs a COPY query on its own connection taken from the pool and commits it.
+    The rows of stl_load_errors of the COPY are fetched whether it succeeded or not.
+    :param pool: psycopg2 connection pool
+    :param query: COPY query
+    :return: dict with the table, the seconds the COPY took, the error message (None if it succeeded)
+             and the load errors (filename, line number, column, error code, reason)
+    """
+    result = {'table': copy_target(query), 'error': None, 'load_errors': []}
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        start = time.time()
+        try:
+            cur.execute(query)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            result['error'] = str(e).strip()
+        result['seconds'] = time.time() - start
+
+        cur.execute(load_errors_select, (MAX_LOAD_ERRORS,))
+        result['load_errors'] = cur.fetchall()
         conn.commit()
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+    return result
+
+
+def load_staging_tables(pool):
+    """
+    Loads events and songs data from S3 to Redshift (staging tables).
+    The COPY queries do not depend on each other, so they run at the same time, each one on its own connection
+    of the pool. All of them run to the end even if one fails; the failed tables are raised together afterwards.
+    :param pool: psycopg2 connection pool
+    :return: list of results of run_copy
+    """
+    print('Loading staging tables...')
+    with ThreadPoolExecutor(max_workers=min(len(copy_table_queries), pool.maxconn)) as executor:
+        futures = [(copy_target(query), executor.submit(run_copy, pool, query)) for query in copy_table_queries]
+
+    results = []
+    for table, future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            # the connection was lost before the COPY could be checked
+            result = {'table': table, 'seconds': None, 'error': str(e).strip(), 'load_errors': []}
+        results.append(result)
+
+        if result['error'] is None:
+            print('{}: loaded in {:.1f} s'.format(table, result['seconds']))
+        else:
+            print('{}: FAILED{}: {}'.format(
+                table, ' after {:.1f} s'.format(result['seconds']) if result['seconds'] is not None else '',
+                result['error']))
+        for filename, line_number, column, code, reason in result['load_errors']:
+            print('    {}:{} column {} error {}: {}'.format(filename, line_number, column, code, reason))
+
+    failed = [r['table'] for r in results if r['error'] is not None]
+    if failed:
+        raise RuntimeError('Could not load the staging tables: {}'.format(', '.join(failed)))
     print('LOADED!')
+    return results
+
+
+def order_steps(steps):
+    """
+    Checks the dependencies of the steps and sorts them so every step comes after the steps it depends on.
+    :param steps: list of tuples (name, query, names of the steps it depends on)
+    :return: list of the steps, in dependency order (the given order is kept where possible)
+    """
+    names = [name for name, _, _ in steps]
+    for name, _, dependencies in steps:
+        unknown = [d for d in dependencies if d not in names]
+        if unknown:
+            raise ValueError('{} depends on unknown steps: {}'.format(name, ', '.join(unknown)))
+
+    ordered, done = [], set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if set(step[2]) <= done]
+        if not ready:
+            raise ValueError('Circular dependencies between {}'.format(', '.join(step[0] for step in remaining)))
+        for step in ready:
+            ordered.append(step)
+            done.add(step[0])
+            remaining.remove(step)
+    return ordered
+
+
+def run_step(pool, name, query):
+    """
+    Runs a query on its own connection taken from the pool and commits it.
+    :param pool: psycopg2 connection pool
+    :param name: name of the step
+    :param query: query
+    :return: dict with the step, the start and end times, the rows inserted and the error message
+             (None if it succeeded)
+    """
+    result = {'step': name, 'error': None, 'rows': None}
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        result['start'] = time.time()
+        try:
+            cur.execute(query)
+            conn.commit()
+            result['rows'] = cur.rowcount
+        except psycopg2.Error as e:
+            conn.rollback()
+            result['error'] = str(e).strip()
+        result['end'] = time.time()
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+    return result
+
+
+def run_steps(pool, steps):
+    """
+    Runs queries that depend on each other: a query starts, on its own connection of the pool, as soon as
+    the queries it depends on are committed, so independent queries run at the same time.
+    The queries that depend on a failed query are skipped; the other ones still run.
+    :param pool: psycopg2 connection pool
+    :param steps: list of tuples (name, query, names of the steps it depends on)
+    :return: list of results of run_step, in dependency order
+    """
+    pending = order_steps(steps)
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=min(len(steps), pool.maxconn)) as executor:
+        while pending or running:
+            for step in list(pending):
+                name, query, dependencies = step
+                failed = [d for d in dependencies if d in results and results[d]['error'] is not None]
+                if failed:
+                    results[name] = {'step': name, 'start': None, 'end': None, 'rows': None,
+                                     'error': 'skipped, {} failed'.format(', '.join(failed))}
+                    pending.remove(step)
+                elif all(d in results for d in dependencies):
+                    running[executor.submit(run_step, pool, name, query)] = name
+                    pending.remove(step)
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # the connection was lost before the query could run
+                    results[name] = {'step': name, 'start': None, 'end': None, 'rows': None, 'error': str(e).strip()}
+    return [results[name] for name, _, _ in order_steps(steps)]
 
 
-def insert_tables(cur, conn):
+def print_timeline(results, width=40):
+    """
+    Prints when each step started and ended, in seconds since the first step started, with a bar per step.
+    :param results: list of results of run_steps
+    :param width: number of characters of the longest bar
+    :return: None
+    """
+    started = [r for r in results if r['start'] is not None]
+    origin = min(r['start'] for r in started) if started else 0
+    span = max([r['end'] - origin for r in started] + [1e-9])
+
+    line = '{:<10} {:>8} {:>8} {:>10}  {}'
+    print(line.format('step', 'start', 'end', 'rows', ''))
+    for r in results:
+        if r['start'] is None:
+            print(line.format(r['step'], '', '', '', r['error']))
+            continue
+        begin, end = int(round((r['start'] - origin) / span * width)), int(round((r['end'] - origin) / span * width))
+        bar = ' ' * begin + '#' * max(end - begin, 1)
+        print(line.format(r['step'], '{:.1f}'.format(r['start'] - origin), '{:.1f}'.format(r['end'] - origin),
+                          '' if r['rows'] is None else r['rows'],
+                          '|{:<{}}|'.format(bar, width) + ('' if r['error'] is None else ' FAILED: ' + r['error'])))
+
+
+def insert_tables(pool):
     """
     Extracts data from the Redshift staging tables, transforms and loads it
     into other Redshift tables to be queried by data analysts.
+    The inserts run as soon as the tables they read are loaded (see insert_table_steps), so only times
+    waits for songplays. A timeline of the inserts is printed at the end.
+    :param pool: psycopg2 connection pool
+    :return: list of results of run_steps
+    """
+    print('Inserting data into OLAP tables')
+    results = run_steps(pool, insert_table_steps)
+    print_timeline(results)
+
+    failed = [r['step'] for r in results if r['error'] is not None]
+    if failed:
+        raise RuntimeError('Could not insert data into: {}'.format(', '.join(failed)))
+    print('DONE!')
+    return results
+
+
+def truncate_staging_tables(cur, conn):
+    """
+    Empties the staging tables, so the next COPY loads only the new input files.
     :param cur: psycopg2 cursor
     :param conn: psycopg2 connection
     :return: None
     """
-    print('Inserting data into OLAP tables')
+    for query in truncate_staging_queries:
+        cur.execute(query)
+        conn.commit()
 
-    for query in insert_table_queries:
-        print('Running query:')
-        print(query)
 
-        cur.execute(query)
+def upsert_dimensions(cur, upserts):
+    """
+    Merges the staging rows into dimension tables by primary key (see sql_queries.upsert_queries)
+    and prints the rows deleted and inserted in each table.
+    :param cur: psycopg2 cursor
+    :param upserts: list of tuples (table, queries of upsert_queries)
+    :return: None
+    """
+    for table, queries in upserts:
+        row_counts = {}
+        for name, query in queries:
+            cur.execute(query)
+            if name:
+                row_counts[name] = cur.rowcount
+        print('{}: {deleted} rows deleted, {inserted} rows inserted'.format(table, **row_counts))
+
+
+def upsert_tables(cur, conn):
+    """
+    Merges the staging rows into the star schema tables in a single transaction: only the new keys and the keys
+    whose columns changed (such as the level of a user) are written to the dimensions, and only the song plays
+    that are not in songplays yet are inserted, so a day can be loaded again. If any query fails, no table is changed.
+    :param cur: psycopg2 cursor
+    :param conn: psycopg2 connection
+    :return: None
+    """
+    print('Upserting data into OLAP tables')
+    try:
+        # the new plays are matched against every song loaded so far, not only the new song files
+        upsert_dimensions(cur, song_dimension_upserts)
+        cur.execute(songplay_table_upsert)
+        print('songplays: {} new rows inserted'.format(cur.rowcount))
+        upsert_dimensions(cur, event_dimension_upserts)
         conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
 
     print('DONE!')
 
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Loads the Sparkify data from S3 into the Redshift star schema')
+    parser.add_argument('--upsert', action='store_true',
+                        help='empty the staging tables, load the files LOG_DATA/SONG_DATA (or the manifests) '
+                             'of dwh.cfg point to, which must be the new files only, and merge them into the existing '
+                             'tables, without running create_tables.py first')
+    return parser.parse_args()
+
+
 def main():
     """
     Main method.
@@ -44,17 +299,36 @@ def main():
     into other Redshift tables to be queried by data analysts.
     :return: None
     """
+    args = parse_args()
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    pool = ThreadedConnectionPool(1, MAX_CONNECTIONS,
+                                  "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    try:
+        if args.upsert:
+            conn = pool.getconn()
+            try:
+                truncate_staging_tables(conn.cursor(), conn)
+            finally:
+                pool.putconn(conn)
 
-    conn.close()
+        try:
+            load_staging_tables(pool)
+            if args.upsert:
+                conn = pool.getconn()
+                try:
+                    upsert_tables(conn.cursor(), conn)
+                finally:
+                    pool.putconn(conn)
+            else:
+                insert_tables(pool)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+    finally:
+        pool.closeall()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
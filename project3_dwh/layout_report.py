@@ -0,0 +1,88 @@
+import configparser
+import psycopg2
+from sql_queries import table_info_select, table_layouts
+
+# tables whose slice with the most rows holds more than this many times the rows of the slice with the fewest
+SKEW_ROWS_WARNING = 4.0
+# tables with more than this percentage of unsorted rows need a VACUUM
+UNSORTED_WARNING = 20.0
+
+
+def expected_diststyle(layout):
+    """
+    Formats the distribution style of a layout as svv_table_info reports it.
+    :param layout: layout of table_layouts
+    :return: string such as 'KEY(song_id)' or 'ALL'
+    """
+    if layout.get('distkey'):
+        return 'KEY({})'.format(layout['distkey'])
+    return layout.get('diststyle', 'AUTO').upper()
+
+
+def table_report(cur):
+    """
+    Reads the distribution and sort of the tables of table_layouts from svv_table_info.
+    :param cur: psycopg2 cursor
+    :return: list of dicts with the table, the expected and actual distribution style, the first sort key,
+             the rows, the row skew between slices, the percentage of sorted rows and the warnings of the table
+    """
+    cur.execute(table_info_select)
+    report = []
+    for table, diststyle, sortkey1, rows, skew_rows, unsorted, stats_off in cur.fetchall():
+        if table not in table_layouts:
+            continue
+        expected = expected_diststyle(table_layouts[table])
+        warnings = []
+        if not diststyle.startswith(expected):
+            warnings.append('distribution {} instead of {}'.format(diststyle, expected))
+        if skew_rows is not None and skew_rows > SKEW_ROWS_WARNING:
+            warnings.append('row skew {:.2f}'.format(skew_rows))
+        if unsorted is not None and unsorted > UNSORTED_WARNING:
+            warnings.append('{:.1f}% unsorted, run VACUUM'.format(unsorted))
+        report.append({
+            'table': table,
+            'expected_diststyle': expected,
+            'diststyle': diststyle,
+            'sortkey1': sortkey1,
+            'rows': rows,
+            'skew_rows': skew_rows,
+            'sorted_pct': None if unsorted is None else 100 - float(unsorted),
+            'stats_off': stats_off,
+            'warnings': warnings
+        })
+    return report
+
+
+def print_report(report):
+    """
+    Prints the report of table_report as a table.
+    :param report: list of dicts returned by table_report
+    :return: None
+    """
+    line = '{:<12} {:<20} {:<14} {:>12} {:>10} {:>9}  {}'
+    print(line.format('table', 'diststyle', 'sortkey1', 'rows', 'skew_rows', 'sorted %', 'warnings'))
+    for r in report:
+        print(line.format(r['table'], r['diststyle'], r['sortkey1'] or '', r['rows'],
+                          '' if r['skew_rows'] is None else '{:.2f}'.format(r['skew_rows']),
+                          '' if r['sorted_pct'] is None else '{:.1f}'.format(r['sorted_pct']),
+                          '; '.join(r['warnings'])))
+
+
+def main():
+    """
+    Main method.
+    Prints the distribution skew and sort percentage of the tables after a load.
+    :return: None
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    try:
+        print_report(table_report(conn.cursor()))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import argparse
+import configparser
+import fnmatch
+import gzip
+import heapq
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# name of the COPY manifest written next to the parts
+MANIFEST_NAME = 'manifest.json'
+# name of each part, numbered from 0
+PART_NAME = 'part-{:05d}.json.gz'
+
+
+def list_source_files(source_dir, pattern='*.json'):
+    """
+    Lists the files of a local directory tree that match a pattern.
+    :param source_dir: local directory, such as the unzipped song-data
+    :param pattern: glob pattern of the file names
+    :return: list of tuples (path, size) sorted by path
+    """
+    files = []
+    for root, _, names in os.walk(source_dir):
+        for name in names:
+            if fnmatch.fnmatch(name, pattern):
+                path = os.path.join(root, name)
+                files.append((path, os.path.getsize(path)))
+    return sorted(files)
+
+
+def cluster_slices():
+    """
+    Counts the slices of the Redshift cluster configured in dwh.cfg.
+    :return: number of slices
+    """
+    import psycopg2
+    from sql_queries import slice_count_select
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    try:
+        cur = conn.cursor()
+        cur.execute(slice_count_select)
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def group_files(files, num_parts):
+    """
+    Groups files into parts of about the same size: the largest files are placed first,
+    each one in the part with the fewest bytes so far.
+    :param files: list of tuples (path, size)
+    :param num_parts: number of parts
+    :return: list of num_parts lists of paths (some may be empty if there are fewer files than parts)
+    """
+    parts = [[] for _ in range(num_parts)]
+    heap = [(0, i) for i in range(num_parts)]
+    for path, size in sorted(files, key=lambda f: (-f[1], f[0])):
+        total, i = heapq.heappop(heap)
+        parts[i].append(path)
+        heapq.heappush(heap, (total + size, i))
+    return [sorted(p) for p in parts]
+
+
+def write_part(paths, part_path, compress_level=6):
+    """
+    Concatenates JSON files into one gzip-compressed part. A newline is added after each file that does not end
+    with one, so every JSON document of the part starts on its own line.
+    :param paths: paths of the source files
+    :param part_path: path of the part
+    :param compress_level: gzip compression level
+    :return: tuple (number of uncompressed bytes, number of compressed bytes)
+    """
+    raw_bytes = 0
+    with gzip.open(part_path, 'wb', compresslevel=compress_level) as part:
+        for path in paths:
+            with open(path, 'rb') as f:
+                content = f.read()
+            if content and not content.endswith(b'\n'):
+                content += b'\n'
+            part.write(content)
+            raw_bytes += len(content)
+    return raw_bytes, os.path.getsize(part_path)
+
+
+def split_inputs(source_dir, output_dir, url_prefix, num_parts, pattern='*.json', compress_level=6, workers=4):
+    """
+    Splits the JSON files of a local directory into gzip-compressed parts of about the same size
+    and writes a Redshift COPY manifest that lists them under url_prefix.
+    :param source_dir: local directory with the source files
+    :param output_dir: local directory where the parts and the manifest are written
+    :param url_prefix: S3 prefix the content of output_dir is uploaded to, such as s3://bucket/song-parts/
+    :param num_parts: number of parts, a multiple of the number of slices of the cluster
+    :param pattern: glob pattern of the source file names
+    :param compress_level: gzip compression level
+    :param workers: number of parts written at the same time
+    :return: dict with the statistics of the split
+    """
+    start = time.time()
+    files = list_source_files(source_dir, pattern)
+    groups = [g for g in group_files(files, num_parts) if g]
+    if len(groups) < num_parts:
+        print('WARNING: {} files for {} parts, {} parts left empty are not written'.format(
+            len(files), num_parts, num_parts - len(groups)))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    names = [PART_NAME.format(i) for i in range(len(groups))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(lambda args: write_part(args[0], os.path.join(output_dir, args[1]), compress_level),
+                                  zip(groups, names)))
+
+    manifest = {'entries': [{'url': url_prefix.rstrip('/') + '/' + name, 'mandatory': True,
+                             'meta': {'content_length': compressed}}
+                            for name, (_, compressed) in zip(names, sizes)]}
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    raw_sizes = [raw for raw, _ in sizes]
+    return {
+        'files': len(files),
+        'parts': len(groups),
+        'raw_bytes': sum(raw_sizes),
+        'gzip_bytes': sum(compressed for _, compressed in sizes),
+        'min_part_bytes': min(raw_sizes) if raw_sizes else 0,
+        'max_part_bytes': max(raw_sizes) if raw_sizes else 0,
+        'seconds': round(time.time() - start, 3)
+    }
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Split local JSON files into gzip parts for a Redshift COPY')
+    parser.add_argument('source', help='local directory with the JSON files, such as the unzipped song-data')
+    parser.add_argument('output', help='local directory where the parts and the manifest are written')
+    parser.add_argument('--url-prefix', required=True,
+                        help='S3 prefix the output directory is uploaded to, such as s3://my-bucket/song-parts/')
+    parser.add_argument('--slices', type=int,
+                        help='number of slices of the cluster (read from the cluster in dwh.cfg if not given)')
+    parser.add_argument('--parts-per-slice', type=int, default=1,
+                        help='number of parts loaded by each slice')
+    parser.add_argument('--pattern', default='*.json', help='glob pattern of the source file names')
+    parser.add_argument('--compress-level', type=int, default=6, help='gzip compression level')
+    parser.add_argument('--workers', type=int, default=4, help='number of parts written at the same time')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main method.
+    Splits the source files into slices * parts-per-slice parts and prints the statistics of the split.
+    :return: None
+    """
+    args = parse_args()
+    slices = args.slices or cluster_slices()
+    num_parts = slices * args.parts_per_slice
+
+    stats = split_inputs(args.source, args.output, args.url_prefix, num_parts, args.pattern, args.compress_level,
+                         args.workers)
+    print('Split {files} files ({raw_bytes} bytes) into {parts} parts ({gzip_bytes} bytes compressed) '
+          'in {seconds} s'.format(**stats))
+    print('Part sizes: {min_part_bytes} to {max_part_bytes} bytes uncompressed'.format(**stats))
+    print('Upload the parts and the manifest with:')
+    print('    aws s3 cp --recursive {} {}'.format(args.output, args.url_prefix))
+    print('then set LOG_MANIFEST or SONG_MANIFEST in dwh.cfg to \'{}/{}\''.format(
+        args.url_prefix.rstrip('/'), MANIFEST_NAME))
+
+
+if __name__ == "__main__":
+    main()
@@ -111,22 +111,78 @@ CREATE TABLE "times" (
 ) 
 """)
 
+# TABLE LAYOUT
+
+# distribution style, distribution key and sort keys of each table, rendered into its CREATE TABLE by create_tables.py.
+# songplays and songs share the distribution key song_id so their join is collocated, the small dimensions
+# (and the staging songs joined with every event) are copied to every node, the events are spread evenly.
+table_layouts = {
+    'stg_events': {'diststyle': 'EVEN'},
+    'stg_songs': {'diststyle': 'ALL'},
+    'songplays': {'distkey': 'song_id', 'sortkey': ['start_time']},
+    'users': {'diststyle': 'ALL', 'sortkey': ['user_id']},
+    'songs': {'distkey': 'song_id', 'sortkey': ['song_id']},
+    'artists': {'diststyle': 'ALL', 'sortkey': ['artist_id']},
+    'times': {'diststyle': 'ALL', 'sortkey': ['start_time']}
+}
+
+# distribution and sort of the tables after the load, compared with table_layouts by layout_report.py
+table_info_select = ("""
+    SELECT "table", diststyle, sortkey1, tbl_rows, skew_rows, unsorted, stats_off
+    FROM svv_table_info
+    WHERE "schema" = current_schema()
+    ORDER BY "table";
+""")
+
 # STAGING TABLES
 
+
+def copy_source(data_key, manifest_key):
+    """
+    Chooses the source of a COPY: the manifest of the parts written by split_inputs.py when it is set in dwh.cfg,
+    the S3 prefix of the original files otherwise.
+    :param data_key: key of the S3 prefix in the S3 section of dwh.cfg
+    :param manifest_key: key of the manifest URL in the S3 section of dwh.cfg
+    :return: tuple (source, COPY options of the source)
+    """
+    manifest = config['S3'].get(manifest_key)
+    if manifest:
+        return manifest, 'MANIFEST GZIP'
+    return config['S3'][data_key], ''
+
+
+events_source, events_source_options = copy_source('LOG_DATA', 'LOG_MANIFEST')
+songs_source, songs_source_options = copy_source('SONG_DATA', 'SONG_MANIFEST')
+
 staging_events_copy = ("""
     copy stg_events from  {} 
     iam_role {}
     region 'us-west-2'
-    FORMAT AS JSON {};
-""").format(config['S3']['LOG_DATA'], config['IAM_ROLE']['ARN'], config['S3']['LOG_JSONPATH'])
+    FORMAT AS JSON {}
+    {};
+""").format(events_source, config['IAM_ROLE']['ARN'], config['S3']['LOG_JSONPATH'], events_source_options)
 
 staging_songs_copy = ("""
     copy stg_songs FROM  {} 
     iam_role {}
     region 'us-west-2'
     COMPUPDATE OFF STATUPDATE OFF
-    json 'auto';
-""").format(config['S3']['SONG_DATA'], config['IAM_ROLE']['ARN'])
+    json 'auto'
+    {};
+""").format(songs_source, config['IAM_ROLE']['ARN'], songs_source_options)
+
+# number of slices of the cluster (see split_inputs.py)
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+# LOAD ERRORS
+
+load_errors_select = ("""
+    SELECT TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason)
+    FROM stl_load_errors
+    WHERE query = pg_last_copy_id()
+    ORDER BY line_number
+    LIMIT %s;
+""")
 
 # FINAL TABLES
 
@@ -195,13 +251,156 @@ time_table_insert = ("""
     FROM  songplays)
 """)
 
+# UPSERTS
+
+
+def row_hash(alias, columns):
+    """
+    Builds an expression with the MD5 of the columns of a row, used to find the rows that changed.
+    :param alias: alias of the table
+    :param columns: list of columns
+    :return: SQL expression
+    """
+    return "MD5({})".format(" || '|' || ".join("NVL(CAST({}.{} AS VARCHAR), '')".format(alias, c) for c in columns))
+
+
+def upsert_queries(table, key, columns, source):
+    """
+    Builds the queries that merge one row per key into a table: the rows are staged in a temporary table,
+    the rows of the table whose columns changed are deleted (delete-join), the staged rows whose key is still
+    in the table (unchanged) are dropped and the remaining ones (new or changed keys) are inserted.
+    They must run in the same transaction.
+    :param table: name of the table
+    :param key: primary key column
+    :param columns: list of columns, key included
+    :param source: query selecting the columns, one row per key
+    :return: list of tuples (name of the row count reported by etl.py or None, query)
+    """
+    staging = 'upsert_' + table
+    return [
+        (None, "CREATE TEMP TABLE {} (LIKE {});".format(staging, table)),
+        (None, "INSERT INTO {} ({}) {};".format(staging, ', '.join(columns), source.strip())),
+        ('deleted', "DELETE FROM {table} USING {staging} s WHERE {table}.{key} = s.{key} AND {old} <> {new};".format(
+            table=table, staging=staging, key=key, old=row_hash(table, columns), new=row_hash('s', columns))),
+        (None, "DELETE FROM {staging} USING {table} t WHERE {staging}.{key} = t.{key};".format(
+            staging=staging, table=table, key=key)),
+        ('inserted', "INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging};".format(
+            table=table, staging=staging, columns=', '.join(columns))),
+        (None, "DROP TABLE {};".format(staging))
+    ]
+
+
+# the latest level of each user is kept
+user_upsert_source = ("""
+    SELECT user_id, first_name, last_name, gender, level
+    FROM (SELECT
+              userId AS user_id,
+              firstName AS first_name,
+              lastName AS last_name,
+              gender,
+              level,
+              ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC, itemInSession DESC) AS rn
+          FROM stg_events
+          WHERE page='NextSong'
+              and userId is not null) AS latest
+    WHERE rn = 1
+""")
+
+song_upsert_source = ("""
+    SELECT song_id, artist_id, title, duration, year
+    FROM (SELECT
+              song_id,
+              artist_id,
+              title,
+              duration,
+              year,
+              ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, title) AS rn
+          FROM stg_songs
+          WHERE song_id is not null) AS songs_by_id
+    WHERE rn = 1
+""")
+
+artist_upsert_source = ("""
+    SELECT artist_id, name, longitude, latitude, location
+    FROM (SELECT
+              artist_id,
+              artist_name AS name,
+              artist_longitude AS longitude,
+              artist_latitude AS latitude,
+              artist_location AS location,
+              ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name, artist_location) AS rn
+          FROM stg_songs
+          WHERE artist_id is not null) AS artists_by_id
+    WHERE rn = 1
+""")
+
+time_upsert_source = ("""
+    SELECT DISTINCT
+        start_time,
+        EXTRACT(hour FROM  start_time) AS hour,
+        EXTRACT(day FROM  start_time) AS day,
+        EXTRACT(week FROM  start_time) AS week,
+        EXTRACT(month FROM  start_time) AS month,
+        EXTRACT(year FROM  start_time) AS year,
+        EXTRACT(weekday FROM  start_time) AS weekday
+    FROM  songplays
+    WHERE start_time IN (SELECT TIMESTAMP 'epoch' + ts/1000 *INTERVAL '1 second'
+                         FROM stg_events
+                         WHERE page='NextSong')
+""")
+
+# new song plays matched against the merged songs and artists (stg_songs only holds the new song files);
+# plays already in the table (same user, session and start time) are not inserted again
+songplay_table_upsert = ("""
+    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    (SELECT
+        TIMESTAMP 'epoch' + ev.ts/1000 *INTERVAL '1 second' AS start_time,
+        ev.userId AS user_id,
+        ev.level,
+        s.song_id,
+        s.artist_id,
+        ev.sessionId AS session_id,
+        ev.location,
+        ev.userAgent AS user_agent
+     FROM  stg_events ev
+     JOIN  songs s ON (ev.song=s.title)
+     JOIN  artists a ON (s.artist_id=a.artist_id and ev.artist=a.name)
+     WHERE  ev.page='NextSong'
+        and NOT EXISTS (SELECT 1
+                        FROM songplays p
+                        WHERE p.user_id=ev.userId
+                            and p.session_id=ev.sessionId
+                            and p.start_time=TIMESTAMP 'epoch' + ev.ts/1000 *INTERVAL '1 second')
+    );
+""")
+
+user_table_upsert = upsert_queries('users', 'user_id', ['user_id', 'first_name', 'last_name', 'gender', 'level'],
+                                   user_upsert_source)
+song_table_upsert = upsert_queries('songs', 'song_id', ['song_id', 'artist_id', 'title', 'duration', 'year'],
+                                   song_upsert_source)
+artist_table_upsert = upsert_queries('artists', 'artist_id', ['artist_id', 'name', 'longitude', 'latitude', 'location'],
+                                     artist_upsert_source)
+time_table_upsert = upsert_queries('times', 'start_time',
+                                   ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+                                   time_upsert_source)
+
+# staging tables are emptied before the COPY of an upsert run, so they hold only the new input files
+staging_events_truncate = "TRUNCATE stg_events"
+staging_songs_truncate = "TRUNCATE stg_songs"
+
 # QUERY LISTS
 
 # original
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
-
-
-
+truncate_staging_queries = [staging_events_truncate, staging_songs_truncate]
+# inserts with the tables each one reads besides staging, run concurrently by etl.py
+insert_table_steps = [('songplays', songplay_table_insert, []), ('users', user_table_insert, []),
+                      ('songs', song_table_insert, []), ('artists', artist_table_insert, []),
+                      ('times', time_table_insert, ['songplays'])]
+insert_table_queries = [query for _, query, _ in insert_table_steps]
+# run in one transaction by etl.py --upsert: the songs and artists the new plays are matched against,
+# then songplay_table_upsert, then the dimensions derived from the events (times is derived from songplays)
+song_dimension_upserts = [('songs', song_table_upsert), ('artists', artist_table_upsert)]
+event_dimension_upserts = [('users', user_table_upsert), ('times', time_table_upsert)]
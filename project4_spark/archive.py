@@ -0,0 +1,140 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import calendar
+import fnmatch
+import logging
+import tarfile
+import threading
+import zipfile
+
+# a JSON file stored in a local zip or tar.gz archive
+# path: path of the file as if the archive was extracted (prefix + name in the archive), size: number of bytes,
+# modified: modification time in epoch milliseconds, archive: path to the archive, name: name in the archive
+# path, size and modified match storage.FileStatus, so members can be used wherever file statuses are
+Member = namedtuple('Member', ['path', 'size', 'modified', 'archive', 'name'])
+
+# number of zip members decompressed at the same time
+READ_THREADS = 8
+
+logger = logging.getLogger(__name__)
+
+
+def is_tar(archive_path):
+    return archive_path.endswith('.tar.gz') or archive_path.endswith('.tgz') or archive_path.endswith('.tar')
+
+
+def matches(path, pattern):
+    """
+    Checks if a path matches a glob pattern. Every level of the pattern matches exactly one level of directories.
+    :param path: relative path
+    :param pattern: glob pattern, such as etl.SONG_FILES_PATH_SUFFIX
+    :return: True if the path matches
+    """
+    parts = path.split('/')
+    segments = pattern.split('/')
+    return len(parts) == len(segments) and all(fnmatch.fnmatchcase(p, s) for p, s in zip(parts, segments))
+
+
+def list_members(archives, pattern):
+    """
+    Lists the members of local archives that match a glob pattern.
+    :param archives: list of tuples (path to a zip or tar.gz archive, prefix of its members),
+                     the prefix is the directory the archive would be extracted to, relative to input_data
+    :param pattern: glob pattern relative to input_data
+    :return: list of Member sorted by path
+    """
+    members = []
+    for archive_path, prefix in archives:
+        if is_tar(archive_path):
+            with tarfile.open(archive_path) as t:
+                entries = [(m.name, m.size, int(m.mtime * 1000)) for m in t.getmembers() if m.isfile()]
+        else:
+            with zipfile.ZipFile(archive_path) as z:
+                entries = [(i.filename, i.file_size, calendar.timegm(i.date_time + (0, 0, 0)) * 1000)
+                           for i in z.infolist() if not i.is_dir()]
+
+        for name, size, modified in entries:
+            path = prefix + (name[2:] if name.startswith('./') else name)
+            if matches(path, pattern):
+                members.append(Member(path, size, modified, archive_path, name))
+    return sorted(members)
+
+
+def read_zip_members(archive_path, members):
+    """
+    Reads members of a zip archive in parallel. Each thread opens its own handle of the archive.
+    :param archive_path: path to the zip archive
+    :param members: list of Member of this archive
+    :return: dict name -> bytes
+    """
+    handles = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def read(member):
+        if not hasattr(handles, 'zip'):
+            handles.zip = zipfile.ZipFile(archive_path)
+            with lock:
+                opened.append(handles.zip)
+        return member.name, handles.zip.read(member.name)
+
+    try:
+        with ThreadPoolExecutor(READ_THREADS) as pool:
+            return dict(pool.map(read, members))
+    finally:
+        for z in opened:
+            z.close()
+
+
+def read_tar_members(archive_path, members):
+    """
+    Reads members of a tar archive. A compressed tar can only be read sequentially, so the archive
+    is read in a single pass.
+    :param archive_path: path to the tar archive
+    :param members: list of Member of this archive
+    :return: dict name -> bytes
+    """
+    names = set(m.name for m in members)
+    contents = {}
+    with tarfile.open(archive_path, 'r|*') as t:
+        for info in t:
+            if info.name in names:
+                contents[info.name] = t.extractfile(info).read()
+    return contents
+
+
+def read_members(members):
+    """
+    Reads the content of archive members into memory, without extracting them to disk.
+    The archives are read at the same time, the members of each zip archive in parallel.
+    :param members: list of Member
+    :return: list of bytes, in the order of members
+    """
+    by_archive = {}
+    for m in members:
+        by_archive.setdefault(m.archive, []).append(m)
+
+    def read(item):
+        archive_path, archive_members = item
+        if is_tar(archive_path):
+            return archive_path, read_tar_members(archive_path, archive_members)
+        return archive_path, read_zip_members(archive_path, archive_members)
+
+    with ThreadPoolExecutor(max(1, len(by_archive))) as pool:
+        contents = dict(pool.map(read, by_archive.items()))
+
+    logger.info('Read %d archive members (%d bytes) from %d archives', len(members),
+                sum(m.size for m in members), len(by_archive))
+    return [contents[m.archive][m.name] for m in members]
+
+
+def read_lines(members):
+    """
+    Reads the JSON lines of archive members.
+    :param members: list of Member
+    :return: list of strings, one per record
+    """
+    lines = []
+    for content in read_members(members):
+        lines.extend(line for line in content.decode('utf-8').splitlines() if line.strip())
+    return lines
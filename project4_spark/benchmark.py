@@ -0,0 +1,462 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+import zlib
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, min as min_
+
+import etl
+import skipping
+from metrics import MetricsRecorder
+from plans import PlanRecorder
+from storage import path_size, read_text
+from writer import FILE_STATS_NAME, partition_directories, record_file_statistics, write_table
+
+# each replica of the samples is shifted by this amount of time, so it lands in other year/month partitions
+REPLICA_TS_SHIFT_MS = 31 * 24 * 60 * 60 * 1000
+# each replica of the samples shifts the numeric ids by this amount
+REPLICA_ID_SHIFT = 1000000
+# row group size of the layout benchmark, small enough to get several row groups out of the samples
+LAYOUT_ROW_GROUP_BYTES = 64 * 1024
+# file size of the index benchmark, small enough to get several files per partition out of the samples
+INDEX_FILE_BYTES = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def replicate_song(record, replica):
+    """
+    Makes a distinct copy of a song record.
+    :param record: song record
+    :param replica: number of the replica (1 or more)
+    :return: song record
+    """
+    suffix = '_R{}'.format(replica)
+    record = dict(record)
+    for field in ['song_id', 'artist_id', 'title', 'artist_name']:
+        if record.get(field) is not None:
+            record[field] += suffix
+    return record
+
+
+def replicate_event(record, replica):
+    """
+    Makes a distinct copy of a log event. The song and artist names get the same suffix as the replicated songs,
+    so the copies still join with them.
+    :param record: log event
+    :param replica: number of the replica (1 or more)
+    :return: log event
+    """
+    suffix = '_R{}'.format(replica)
+    record = dict(record)
+    for field in ['song', 'artist']:
+        if record.get(field) is not None:
+            record[field] += suffix
+    if record.get('ts') is not None:
+        record['ts'] += replica * REPLICA_TS_SHIFT_MS
+    if record.get('sessionId') is not None:
+        record['sessionId'] += replica * REPLICA_ID_SHIFT
+    if record.get('userId'):
+        record['userId'] = str(int(record['userId']) + replica * REPLICA_ID_SHIFT)
+    return record
+
+
+def replicate_file(path, replicate, replica):
+    """
+    Writes a copy of a JSON lines file next to it, with every record replicated.
+    :param path: path to the JSON file
+    :param replicate: function that replicates a record
+    :param replica: number of the replica (1 or more)
+    :return: None
+    """
+    base, ext = os.path.splitext(path)
+    with open(path) as source, open('{}-replica{}{}'.format(base, replica, ext), 'w') as target:
+        for line in source:
+            if line.strip():
+                target.write(json.dumps(replicate(json.loads(line), replica)) + '\n')
+
+
+def read_records(path):
+    """
+    Reads a JSON lines file.
+    :param path: path to the JSON file
+    :return: list of records
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def match_songs(paths):
+    """
+    Rewrites the NextSong events of the log files so each one plays a song of the song files.
+    Only a few events of the samples match a song, this gives the songplays dataset a realistic size.
+    The song of an event is chosen from its original song name, so the result is deterministic.
+    :param paths: paths to the JSON files of the samples
+    :return: None
+    """
+    songs = []
+    for path in paths:
+        if os.sep + 'song_data' + os.sep in path:
+            songs.extend(read_records(path))
+    songs.sort(key=lambda s: s['song_id'])
+
+    for path in paths:
+        if os.sep + 'log_data' + os.sep not in path:
+            continue
+        records = read_records(path)
+        for record in records:
+            if record.get('page') == 'NextSong' and record.get('song') is not None:
+                song = songs[zlib.crc32(record['song'].encode('utf-8')) % len(songs)]
+                record['song'], record['artist'], record['length'] = \
+                    song['title'], song['artist_name'], song['duration']
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(r) + '\n' for r in records)
+
+
+def prepare_input(work_dir, scale, songs_matched=False):
+    """
+    Extracts the samples shipped in the data directory and replicates them to the scale factor.
+    :param work_dir: local directory for the input files
+    :param scale: number of copies of the samples (1 means the samples only)
+    :param songs_matched: make every NextSong event of the samples play a song of the samples (see match_songs)
+    :return: file:// path to the input files
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    input_data = etl.extract_samples(work_dir)
+
+    originals = []
+    for root, _, files in os.walk(work_dir):
+        for name in files:
+            if name.endswith('.json'):
+                originals.append(os.path.join(root, name))
+    if songs_matched:
+        match_songs(originals)
+
+    for replica in range(1, scale):
+        for path in originals:
+            is_song = os.sep + 'song_data' + os.sep in path
+            replicate_file(path, replicate_song if is_song else replicate_event, replica)
+
+    logger.info('Prepared %d input files (scale %d) in %s', len(originals) * scale, scale, work_dir)
+    return input_data
+
+
+def run_benchmark(spark, input_data, output_data, concurrent=False):
+    """
+    Runs every stage of the ETL on local files.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param output_data: path to the output files
+    :param concurrent: build the tables at the same time (see etl.run_concurrent), the session must use FAIR
+    :return: tuple (list of dicts with the measurements of each stage, wall time of the table builds)
+    """
+    recorder = MetricsRecorder(spark).activate()
+
+    song_df, log_df = etl.read_sources(spark, input_data, output_data)
+    try:
+        builds = etl.table_builds(spark, song_df, log_df, output_data)
+        if concurrent:
+            builds_time = etl.run_concurrent(spark, builds)
+        else:
+            builds_time = etl.run_sequential(builds)
+    finally:
+        etl.unpersist_sources(song_df, log_df)
+
+    report = []
+    for record in recorder.records:
+        stats = {
+            'stage': record['stage'],
+            'wall_time_s': record['wall_time_s'],
+            'shuffle_read_bytes': record.get('shuffleReadBytes'),
+            'shuffle_write_bytes': record.get('shuffleWriteBytes')
+        }
+        table = record['stage'].replace('process_', '')
+        if table in etl.OUTPUT_TABLES:
+            stats['output_bytes'] = path_size(spark, output_data + etl.OUTPUT_TABLES[table].path)
+        report.append(stats)
+
+    return report, round(builds_time, 3)
+
+
+def read_file_statistics(spark, path):
+    """
+    Reads the per-file statistics recorded by writer.record_file_statistics for a dataset.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :return: list with the statistics of every file
+    """
+    stats = []
+    for directory in partition_directories(spark, path):
+        text = read_text(spark, directory.rstrip('/') + '/' + FILE_STATS_NAME)
+        if text:
+            stats.extend(json.loads(text))
+    return stats
+
+
+def skipped_row_groups(stats, column, low, high):
+    """
+    Counts the row groups a reader skips for the filter low <= column <= high, using their min/max statistics.
+    :param stats: statistics of the files (see read_file_statistics)
+    :param column: filtered column
+    :param low: lower bound of the filter
+    :param high: upper bound of the filter
+    :return: tuple (number of skipped row groups, number of row groups)
+    """
+    skipped = total = 0
+    for f in stats:
+        for row_group in f['row_groups']:
+            total += 1
+            bounds = row_group['min_max'].get(column)
+            if bounds is None or bounds[1] < low or bounds[0] > high:
+                skipped += 1
+    return skipped, total
+
+
+def layout_queries(df):
+    """
+    Builds the filters of the layout benchmark from the songplays dataset:
+    a single user, a single song and the first day of events.
+    :param df: songplays dataframe
+    :return: list of tuples (name, column, low, high)
+    """
+    row = df.orderBy('songplay_id').first()
+    first = df.agg(min_('start_time')).first()[0]
+    return [
+        ('user_id', 'user_id', row['user_id'], row['user_id']),
+        ('song_id', 'song_id', row['song_id'], row['song_id']),
+        ('start_time_day', 'start_time', first, first + 24 * 60 * 60 * 1000)
+    ]
+
+
+def run_layout_benchmark(spark, output_data, row_group_bytes=LAYOUT_ROW_GROUP_BYTES):
+    """
+    Rewrites the songplays dataset written by run_benchmark with its rows in random order (sorted by songplay_id,
+    an MD5 hash) and with the sort within partitions of etl.OUTPUT_TABLES, and reports for each query
+    how many row groups can be skipped and how long the filtered read takes.
+    :param spark: spark session
+    :param output_data: path to the output files of run_benchmark
+    :param row_group_bytes: size of the Parquet row groups
+    :return: list of dicts with the measurements of each layout and query
+    """
+    table = etl.OUTPUT_TABLES['songplays']
+    df = spark.read.parquet(output_data + table.path)
+    if not df.take(1):
+        logger.info('Empty songplays dataset, run the benchmark with --match-songs')
+        return []
+    queries = layout_queries(df)
+
+    report = []
+    for layout, sort_by in [('unsorted', ['songplay_id']), ('sorted', table.sort_by)]:
+        path = output_data + 'layout/' + layout + '/' + table.path
+        write_table(df, path, table.partition_by, sort_by=sort_by, row_group_bytes=row_group_bytes)
+        record_file_statistics(spark, path, table.stats_columns)
+        stats = read_file_statistics(spark, path)
+
+        for name, column, low, high in queries:
+            skipped, total = skipped_row_groups(stats, column, low, high)
+            start = time.time()
+            rows = spark.read.parquet(path).where(col(column).between(low, high)).count()
+            report.append({
+                'layout': layout,
+                'query': name,
+                'rows': rows,
+                'row_groups': total,
+                'skipped_row_groups': skipped,
+                'read_time_s': round(time.time() - start, 3)
+            })
+
+    return report
+
+
+def run_index_benchmark(spark, output_data, target_file_bytes=INDEX_FILE_BYTES):
+    """
+    Rewrites the songplays dataset written by run_benchmark in small files, indexes it (see skipping.py)
+    and reports for each query how many files the index prunes and the rows read through the index
+    by Spark and by pyarrow, next to the rows of a full scan.
+    :param spark: spark session
+    :param output_data: path to the output files of run_benchmark
+    :param target_file_bytes: target size of the files
+    :return: list of dicts with the measurements of each query
+    """
+    table = etl.OUTPUT_TABLES['songplays']
+    df = spark.read.parquet(output_data + table.path)
+    if not df.take(1):
+        logger.info('Empty songplays dataset, run the benchmark with --match-songs')
+        return []
+
+    path = output_data + 'index/' + table.path
+    write_table(df, path, table.partition_by, target_file_bytes=target_file_bytes, sort_by=table.sort_by)
+    skipping.build_index(spark, path, table.partition_by, table.index)
+    indexed = spark.read.parquet(path)
+
+    report = []
+    for name, column, low, high in layout_queries(df):
+        equal = {column: low} if column in table.index.bloom_columns else None
+        between = {column: (low, high)} if column in table.index.range_columns else None
+        files, total = skipping.prune_files(spark, path, equal, between)
+
+        start = time.time()
+        rows = skipping.read_spark(spark, path, equal, between).count()
+        spark_time = time.time() - start
+
+        start = time.time()
+        arrow_rows = skipping.read_arrow(path, equal, between).num_rows
+        arrow_time = time.time() - start
+
+        report.append({
+            'query': name,
+            'files': total,
+            'pruned_files': total - len(files),
+            'rows': rows,
+            'full_scan_rows': indexed.filter(skipping.filter_condition(equal, between)).count(),
+            'arrow_rows': arrow_rows,
+            'spark_read_time_s': round(spark_time, 3),
+            'arrow_read_time_s': round(arrow_time, 3)
+        })
+
+    return report
+
+
+def local_size(path):
+    """
+    Computes the total size of the files under a local directory.
+    :param path: file:// path or local path
+    :return: number of bytes
+    """
+    path = path.replace('file://', '', 1)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def run_local_benchmark(input_data, output_data):
+    """
+    Runs every stage of the ETL with the pyarrow/pandas engine (see local_engine.py).
+    :param input_data: path to the input files
+    :param output_data: path to the output files
+    :return: list of dicts with the measurements of each stage
+    """
+    import local_engine
+
+    report = []
+
+    start = time.time()
+    song_df, log_df = local_engine.read_sources(input_data, output_data)
+    report.append({'stage': 'read_sources', 'wall_time_s': round(time.time() - start, 3)})
+
+    stages = [
+        ('process_songs', 'songs', local_engine.process_songs, (song_df, output_data)),
+        ('process_artists', 'artists', local_engine.process_artists, (song_df, output_data)),
+        ('process_users', 'users', local_engine.process_users, (log_df, output_data)),
+        ('process_times', 'times', local_engine.process_times, (log_df, output_data)),
+        ('process_songplays', 'songplays', local_engine.process_songplays, (log_df, song_df, output_data)),
+        ('process_sessions', 'sessions', local_engine.process_sessions, (log_df, output_data))
+    ]
+    for name, table, func, args in stages:
+        start = time.time()
+        func(*args)
+        report.append({
+            'stage': name,
+            'wall_time_s': round(time.time() - start, 3),
+            'output_bytes': local_size(output_data + etl.OUTPUT_TABLES[table].path)
+        })
+
+    return report
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of the Sparkify ETL on the local samples')
+    parser.add_argument('--scale', type=int, default=1, help='number of copies of the samples')
+    parser.add_argument('--work-dir', default='/tmp/sparkify_benchmark', help='local directory for inputs and outputs')
+    parser.add_argument('--master', default='local[*]',
+                        help='spark master, also used with --profile (instead of the master of the profile)')
+    parser.add_argument('--profile', choices=sorted(etl.SESSION_PROFILES),
+                        help='create the session with etl.create_spark_session and this profile instead of --master')
+    parser.add_argument('--compare-engines', action='store_true',
+                        help='also run the pyarrow/pandas engine and report both engines, including session startup')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='also build the tables concurrently in FAIR scheduler pools and report both wall times')
+    parser.add_argument('--match-songs', action='store_true',
+                        help='make every NextSong event of the samples play a song of the samples')
+    parser.add_argument('--layout', action='store_true',
+                        help='also report the row groups skipped by filtered reads of songplays, '
+                             'with and without the sort within partitions')
+    parser.add_argument('--index', action='store_true',
+                        help='also report the files of songplays pruned by the data-skipping index on sample queries')
+    parser.add_argument('--row-group-bytes', type=int, default=LAYOUT_ROW_GROUP_BYTES,
+                        help='size of the Parquet row groups of the layout benchmark')
+    parser.add_argument('--plans-dir',
+                        help='directory where the physical plans of the sequential table builds are saved '
+                             '(compare two runs with plans.py)')
+    parser.add_argument('--plans-version',
+                        help='name of the subdirectory of --plans-dir of this run (UTC time of the run by default)')
+    parser.add_argument('--report', help='file where the JSON report is written (printed if not given)')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    args = parse_args()
+
+    input_data = prepare_input(os.path.join(args.work_dir, 'input'), args.scale, args.match_songs)
+    output_data = 'file://' + os.path.abspath(os.path.join(args.work_dir, 'output')) + '/'
+
+    report = {
+        'scale': args.scale
+    }
+
+    if args.compare_engines:
+        start = time.time()
+        report['local_stages'] = run_local_benchmark(input_data, output_data + 'local/')
+        report['local_total_s'] = round(time.time() - start, 3)
+
+    if args.concurrent:
+        os.environ.setdefault('PYSPARK_PIN_THREAD', 'true')
+
+    start = time.time()
+    if args.profile:
+        # the benchmark reads and writes local files only, so no S3 jars are resolved
+        spark = etl.create_spark_session('FAIR' if args.concurrent else 'FIFO', args.profile, s3=False,
+                                         master=args.master)
+        report['profile'] = args.profile
+    else:
+        spark = SparkSession.builder \
+            .master(args.master) \
+            .config('spark.sql.session.timeZone', 'UTC') \
+            .config('spark.scheduler.mode', 'FAIR' if args.concurrent else 'FIFO') \
+            .getOrCreate()
+    report['master'] = spark.sparkContext.master
+    report['spark_session_s'] = round(time.time() - start, 3)
+    plan_recorder = PlanRecorder(args.plans_dir, args.plans_version).activate() if args.plans_dir else None
+    report['stages'], report['sequential_builds_s'] = run_benchmark(spark, input_data, output_data)
+    if plan_recorder:
+        plan_recorder.deactivate()
+        report['plans'] = plan_recorder.write({'spark_version': spark.version, 'scale': args.scale,
+                                               'master': report['master'], 'profile': args.profile,
+                                               'match_songs': args.match_songs})
+    report['spark_total_s'] = round(time.time() - start, 3)
+
+    if args.concurrent:
+        report['concurrent_stages'], report['concurrent_builds_s'] = \
+            run_benchmark(spark, input_data, output_data + 'concurrent/', concurrent=True)
+        report['concurrent_speedup'] = round(report['sequential_builds_s'] / report['concurrent_builds_s'], 2)
+    if args.layout:
+        report['layout'] = run_layout_benchmark(spark, output_data, args.row_group_bytes)
+    if args.index:
+        report['index'] = run_index_benchmark(spark, output_data)
+
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,31 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 from datetime import datetime
+import json
+import logging
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
+import tempfile
+import time
+import zipfile
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import udf, col, lit, concat_ws, md5
+from pyspark.sql.functions import array, broadcast, explode, hash as hash_, pmod
+from pyspark.sql.functions import count, first, lag, lead, max as max_, min as min_, sum as sum_, when
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.types import DateType, TimestampType
+from pyspark.sql.types import TimestampType
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType
+import archive
+from manifest import manifest_files
+from markers import is_complete, stage_marker, tracked
+from metrics import MetricsRecorder, instrument
+from plans import PlanRecorder, building
+from skipping import SkippingIndex, build_index
+from storage import FileStatus, hadoop_path, list_files, read_text, write_text
+from writer import estimated_size, write_table, upsert_partitions, append_new_rows, compact_dataset
+from writer import partition_filter, read_existing, record_file_statistics
 
 config = configparser.ConfigParser()
 config.read('dl.cfg')
@@ -18,151 +39,748 @@ S3_PATH = "s3a://udacity-de-edgar/data/"
 SONG_FILES_PATH_SUFFIX = 'song_data/*/*/*/*.json'
 LOG_FILES_PATH_SUFFIX = 'log_data/*.json'
 
+# packages added to the spark session and local directory where they are cached, so later sessions start offline
+JAR_PACKAGES = ['org.apache.hadoop:hadoop-aws:2.7.0']
+JAR_CACHE_DIR = os.environ.get('SPARKIFY_JAR_CACHE', os.path.join(os.path.expanduser('~'), '.sparkify', 'ivy'))
 
-def create_spark_session():
+# spark settings of the session profiles: local-small for the samples, local-large for a few GB on one machine
+# and cluster for the full dataset on EMR (the master is set by spark-submit)
+SESSION_PROFILES = {
+    'local-small': {
+        'spark.master': 'local[*]',
+        'spark.sql.shuffle.partitions': '4',
+        'spark.sql.adaptive.enabled': 'true',
+        'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+        'spark.sql.autoBroadcastJoinThreshold': str(32 * 1024 * 1024),
+        'spark.memory.fraction': '0.6',
+        'spark.memory.storageFraction': '0.3',
+        'spark.ui.showConsoleProgress': 'false'
+    },
+    'local-large': {
+        'spark.master': 'local[*]',
+        'spark.sql.shuffle.partitions': '64',
+        'spark.sql.adaptive.enabled': 'true',
+        'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+        'spark.sql.autoBroadcastJoinThreshold': str(64 * 1024 * 1024),
+        'spark.memory.fraction': '0.7',
+        'spark.memory.storageFraction': '0.5'
+    },
+    'cluster': {
+        'spark.sql.shuffle.partitions': '400',
+        'spark.sql.adaptive.enabled': 'true',
+        'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+        'spark.sql.adaptive.skewJoin.enabled': 'true',
+        'spark.sql.autoBroadcastJoinThreshold': str(128 * 1024 * 1024),
+        'spark.memory.fraction': '0.6',
+        'spark.memory.storageFraction': '0.5'
+    }
+}
+# local inputs up to this size use the local-small profile when the profile is chosen automatically
+LOCAL_SMALL_MAX_BYTES = 256 * 1024 * 1024
+
+# local samples of the input files shipped with this project
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SONG_SAMPLE_ZIP = 'song-data.zip'
+LOG_SAMPLE_ZIP = 'log-data.zip'
+# sample archives and the directory (relative to input_data) their members belong to
+SAMPLE_ARCHIVES = [(SONG_SAMPLE_ZIP, ''), (LOG_SAMPLE_ZIP, 'log_data/')]
+
+# record layouts of the input files
+SONG_SCHEMA = StructType([
+    StructField('num_songs', LongType()),
+    StructField('artist_id', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_longitude', DoubleType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_name', StringType()),
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('duration', DoubleType()),
+    StructField('year', LongType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', LongType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType())
+])
+
+# columns actually used by the process_* functions. Only these are parsed from the input files.
+SONG_COLUMNS = ['song_id', 'title', 'artist_id', 'year', 'duration', 'artist_name', 'artist_location',
+                'artist_latitude', 'artist_longitude']
+LOG_COLUMNS = ['userId', 'firstName', 'lastName', 'gender', 'level', 'ts', 'page', 'song', 'artist',
+               'sessionId', 'itemInSession', 'location', 'userAgent']
+
+# attributes that identify a songplay event. songplay_id is derived from them, so it is the same on every run.
+SONGPLAY_KEY_COLUMNS = ['userId', 'sessionId', 'itemInSession', 'ts']
+
+# malformed records are kept in this column and appended to the quarantine dataset,
+# partitioned by the id of the run (its start time in UTC)
+CORRUPT_RECORD_COLUMN = '_corrupt_record'
+QUARANTINE_PATH_SUFFIX = 'quarantine/'
+QUARANTINE_PARTITION_COLUMN = 'run_id'
+RUN_ID_FORMAT = '%Y%m%dT%H%M%SZ'
+
+# output datasets: path (relative to output_data), partition columns, columns used to sort the rows
+# within each partition, columns whose per-file min/max statistics are recorded and data-skipping index
+OutputTable = namedtuple('OutputTable', ['path', 'partition_by', 'sort_by', 'stats_columns', 'index'])
+OUTPUT_TABLES = {
+    'songs': OutputTable('out_songs/songs.parquet', ['year', 'artist_id'], [], [], None),
+    'artists': OutputTable('out_artists/artists.parquet', [], [], [], None),
+    'users': OutputTable('out_users/users.parquet', [], [], [], None),
+    'times': OutputTable('out_times/times.parquet', ['year', 'month'], ['start_time'], ['start_time'], None),
+    'songplays': OutputTable('out_songplays/songplays.parquet', ['year', 'month'], ['user_id', 'start_time'],
+                             ['user_id', 'song_id', 'start_time'],
+                             SkippingIndex(['user_id', 'song_id'], ['start_time'])),
+    'sessions': OutputTable('out_sessions/sessions.parquet', ['year', 'month'], ['user_id', 'start_time'], [], None)
+}
+# inputs each output table is built from, fingerprinted in its completion marker (see markers.py)
+TABLE_INPUTS = {
+    'songs': ['song_data'],
+    'artists': ['song_data'],
+    'users': ['log_data'],
+    'times': ['log_data'],
+    'songplays': ['song_data', 'log_data'],
+    'sessions': ['log_data']
+}
+# columns that identify a session of the sessions dataset
+SESSION_KEY_COLUMNS = ['session_id', 'user_id']
+
+# watermark of the log files already processed (used by the incremental mode)
+WATERMARK_PATH_SUFFIX = '_watermark/log_data.json'
+
+# the song side of the songplays join is broadcast when its estimated size (bytes) is below this threshold
+SONG_BROADCAST_THRESHOLD = 64 * 1024 * 1024
+# when it is not broadcast, (song, artist) keys with more log events than this are salted into SKEW_SALT_BUCKETS
+SKEW_HOT_KEY_ROWS = 100000
+SKEW_SALT_BUCKETS = 16
+
+# storage level used to keep the song and log datasets in memory for the whole run
+SOURCE_STORAGE_LEVEL = 'MEMORY_AND_DISK'
+
+logger = logging.getLogger(__name__)
+
+
+def cached_jars(cache_dir=JAR_CACHE_DIR):
+    """
+    Finds the jars of JAR_PACKAGES downloaded by a previous session. Ivy copies the jars of the packages
+    and of their dependencies to the jars directory of spark.jars.ivy.
+    :param cache_dir: directory used as spark.jars.ivy
+    :return: list of paths to the jars or None if a package is missing
+    """
+    jars_dir = os.path.join(cache_dir, 'jars')
+    if not os.path.isdir(jars_dir):
+        return None
+
+    names = sorted(n for n in os.listdir(jars_dir) if n.endswith('.jar'))
+    for package in JAR_PACKAGES:
+        group, artifact, version = package.split(':')
+        if '{}_{}-{}.jar'.format(group, artifact, version) not in names:
+            return None
+    return [os.path.join(jars_dir, n) for n in names]
+
+
+def is_local_path(path):
+    """
+    Checks if a path is in the local file system.
+    :param path: path or URI
+    :return: True for local paths and file:// URIs
+    """
+    return '://' not in path or path.startswith('file://')
+
+
+def local_input_size(input_data):
+    """
+    Computes the size of the files under a local input directory.
+    :param input_data: path to the input files
+    :return: number of bytes or None if the input is not in the local file system
+    """
+    if not is_local_path(input_data):
+        return None
+    path = input_data.replace('file://', '', 1)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def choose_profile(input_data, archives=None):
+    """
+    Chooses the session profile that matches the location and size of the input.
+    :param input_data: path to the input files
+    :param archives: local archives the input files are read from, instead of input_data (see archive_inputs)
+    :return: name of a profile of SESSION_PROFILES
+    """
+    if archives:
+        size = sum(m.size for pattern in [SONG_FILES_PATH_SUFFIX, LOG_FILES_PATH_SUFFIX]
+                   for m in archive.list_members(archives, pattern))
+    else:
+        size = local_input_size(input_data)
+    if size is None:
+        return 'cluster'
+    return 'local-small' if size <= LOCAL_SMALL_MAX_BYTES else 'local-large'
+
+
+def create_spark_session(scheduler_mode='FIFO', profile=None, s3=True, master=None):
     """
     Creates a spark session
+    :param scheduler_mode: FIFO or FAIR (needed by the concurrent table builds, see run_concurrent)
+    :param profile: name of a profile of SESSION_PROFILES (Spark defaults if None)
+    :param s3: add the JAR_PACKAGES needed to read and write S3 (not needed for local files)
+    :param master: spark master, replaces the master of the profile (the master of spark-submit if None)
     :return: a spark session
     """
-    spark = SparkSession \
+    if scheduler_mode == 'FAIR':
+        # local properties such as the scheduler pool are set per python thread only in pinned thread mode
+        os.environ.setdefault('PYSPARK_PIN_THREAD', 'true')
+
+    builder = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+        .config("spark.sql.session.timeZone", "UTC") \
+        .config("spark.scheduler.mode", scheduler_mode)
+
+    # the cached jars are added directly, so the session does not resolve the packages in the maven repositories
+    jars = cached_jars() if s3 else None
+    if jars:
+        builder = builder.config("spark.jars", ','.join(jars))
+    elif s3:
+        builder = builder \
+            .config("spark.jars.packages", ','.join(JAR_PACKAGES)) \
+            .config("spark.jars.ivy", JAR_CACHE_DIR)
+
+    for key, value in SESSION_PROFILES.get(profile, {}).items():
+        builder = builder.config(key, value)
+    if master:
+        builder = builder.master(master)
+
+    start = time.time()
+    spark = builder.getOrCreate()
+    logger.info('Spark session (profile %s, %s jars) built in %.2f s', profile or 'default',
+                'no' if not s3 else 'cached' if jars else 'resolved', time.time() - start)
     return spark
 
 
-def process_songs(spark, input_data, output_data):
+def input_stats(spark, df):
+    """
+    Computes how many files and bytes a dataframe reads from its source, with one call to the file system per file.
+    Used for glob reads only: the sizes of listed files are passed to read_source.
+    :param spark: spark session
+    :param df: dataframe created by one of the spark.read methods
+    :return: tuple (number of files, number of bytes)
+    """
+    files = df.inputFiles()
+    num_bytes = 0
+    for f in files:
+        fs, path = hadoop_path(spark, f)
+        num_bytes += fs.getFileStatus(path).getLen()
+
+    return len(files), num_bytes
+
+
+def read_schema(schema, columns):
+    """
+    Builds the schema used to read an input dataset: only the given columns of the record layout
+    plus a column that keeps the malformed records.
+    :param schema: StructType with the full record layout
+    :param columns: names of the columns to be read
+    :return: StructType
+    """
+    fields = [f for f in schema.fields if f.name in columns]
+    return StructType(fields + [StructField(CORRUPT_RECORD_COLUMN, StringType())])
+
+
+def read_source(spark, name, path, schema, output_data, storage_level=SOURCE_STORAGE_LEVEL, run_id=None):
+    """
+    Reads one of the input datasets with a declared schema and persists it so it is scanned only once per run.
+    Malformed records are appended to the quarantine dataset in Parquet format, in the partition of the run,
+    and removed from the returned dataframe. The records quarantined by earlier runs are kept.
+    The number of files and bytes read is logged.
+    :param spark: spark session
+    :param name: name of the dataset
+    :param path: path (or glob) to the input files, list of paths, list of storage.FileStatus or list of archive.Member
+    :param schema: schema returned by read_schema
+    :param output_data: path to the output files
+    :param storage_level: name of the pyspark StorageLevel used to persist the dataset
+    :param run_id: partition of the quarantine dataset (the current time formatted with RUN_ID_FORMAT when None)
+    :return: persisted dataframe
+    """
+    reader = spark.read \
+        .schema(schema) \
+        .option('mode', 'PERMISSIVE') \
+        .option('columnNameOfCorruptRecord', CORRUPT_RECORD_COLUMN)
+
+    if isinstance(path, list) and path and isinstance(path[0], archive.Member):
+        # the records of the archive members are parsed from memory by the executors
+        lines = archive.read_lines(path)
+        raw_df = reader.json(spark.sparkContext.parallelize(lines, spark.sparkContext.defaultParallelism))
+        num_files, num_bytes = len(path), sum(m.size for m in path)
+        source = 'archives'
+    elif isinstance(path, list) and path and isinstance(path[0], FileStatus):
+        # the sizes are known from the listing of the input files, no file is stat'ed again
+        raw_df = reader.json([f.path for f in path])
+        num_files, num_bytes = len(path), sum(f.size for f in path)
+        source = 'file list'
+    else:
+        raw_df = reader.json(path)
+        num_files, num_bytes = input_stats(spark, raw_df)
+        source = path if isinstance(path, str) else 'file list'
+    logger.info('Source %s: read %d files (%d bytes) from %s', name, num_files, num_bytes, source)
+
+    raw_df.persist(getattr(StorageLevel, storage_level))
+
+    # move malformed records to the quarantine dataset
+    corrupt_df = raw_df.filter(col(CORRUPT_RECORD_COLUMN).isNotNull())
+    num_corrupt = corrupt_df.count()
+    if num_corrupt > 0:
+        logger.warning('Source %s: %d malformed records moved to quarantine', name, num_corrupt)
+        corrupt_df.withColumn(QUARANTINE_PARTITION_COLUMN, lit(run_id or datetime.utcnow().strftime(RUN_ID_FORMAT))) \
+            .write.mode('append').partitionBy(QUARANTINE_PARTITION_COLUMN) \
+            .parquet(output_data + QUARANTINE_PATH_SUFFIX + name)
+
+    df = raw_df.filter(col(CORRUPT_RECORD_COLUMN).isNull()).drop(CORRUPT_RECORD_COLUMN)
+    df.persist(getattr(StorageLevel, storage_level)).count()
+    raw_df.unpersist()
+
+    return df
+
+
+@instrument
+def read_sources(spark, input_data, output_data, storage_level=SOURCE_STORAGE_LEVEL, log_files=None,
+                 song_files=None):
+    """
+    Reads the song and log datasets once. The same dataframes are shared by all process_* functions
+    and must be released with unpersist_sources when the run ends.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param output_data: path to the output files (malformed records are quarantined there)
+    :param storage_level: name of the pyspark StorageLevel used to persist the datasets
+    :param log_files: paths, storage.FileStatus or archive.Member of the log files to be read.
+                      All log files are read when it is None.
+    :param song_files: paths, storage.FileStatus or archive.Member of the song files to be read.
+                       All song files are read when it is None.
+    :return: tuple (song dataframe, log dataframe)
+    """
+    if song_files is None:
+        song_files = input_data + SONG_FILES_PATH_SUFFIX
+    if log_files is None:
+        log_files = input_data + LOG_FILES_PATH_SUFFIX
+
+    run_id = datetime.utcnow().strftime(RUN_ID_FORMAT)
+    song_df = read_source(spark, 'song_data', song_files, read_schema(SONG_SCHEMA, SONG_COLUMNS), output_data,
+                          storage_level, run_id)
+    log_df = read_source(spark, 'log_data', log_files, read_schema(LOG_SCHEMA, LOG_COLUMNS), output_data,
+                         storage_level, run_id)
+    return song_df, log_df
+
+
+def list_log_files(spark, input_data, output_data, log_pattern, refresh=False):
+    """
+    Lists the log files matching a glob. Globs of files in the directories of LOG_FILES_PATH_SUFFIX
+    are answered from the log_data manifest, the others are listed directly.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param output_data: path to the output files (the manifests are saved there)
+    :param log_pattern: glob of the log files relative to input_data, such as 'log_data/2018-11-05-*.json'
+    :param refresh: list every prefix of the manifest again
+    :return: list of FileStatus sorted by path
+    """
+    segments = log_pattern.split('/')
+    manifest_segments = LOG_FILES_PATH_SUFFIX.split('/')
+    if segments[:-1] != manifest_segments[:-1] or not segments[-1].endswith('.json'):
+        return list_files(spark, input_data + log_pattern)
+
+    files = manifest_files(spark, input_data, output_data, 'log_data', LOG_FILES_PATH_SUFFIX, refresh)
+    return [f for f in files if archive.matches('/'.join(f.path.split('/')[-len(segments):]), log_pattern)]
+
+
+def read_watermark(spark, output_data):
     """
-    Reads the song dataset and creates the dimension song dataset.
+    Reads the watermark saved by the last run.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :return: dict with the keys last_modified, last_files and max_ts or None if there was no previous run
+    """
+    text = read_text(spark, output_data + WATERMARK_PATH_SUFFIX)
+    return json.loads(text) if text else None
+
+
+def write_watermark(spark, output_data, log_files, log_df):
+    """
+    Saves the watermark of the log files processed in this run.
+    The watermark keeps the most recent modification time and the files modified at that time,
+    so files modified later (or at the very same time but not seen yet) are picked by the next run.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :param log_files: list of FileStatus of the log files processed
+    :param log_df: log dataset processed
+    :return: None
+    """
+    last_modified = max(f.modified for f in log_files)
+    watermark = {
+        'last_modified': last_modified,
+        'last_files': [f.path for f in log_files if f.modified == last_modified],
+        'max_ts': log_df.agg(max_('ts')).first()[0],
+        'updated_at': datetime.utcnow().isoformat()
+    }
+    write_text(spark, output_data + WATERMARK_PATH_SUFFIX, json.dumps(watermark))
+    logger.info('Watermark updated: %s', watermark)
+
+
+def new_log_files(log_files, watermark):
+    """
+    Selects the log files that were not processed by the previous runs.
+    :param log_files: list of FileStatus of all the log files
+    :param watermark: watermark returned by read_watermark
+    :return: list of FileStatus
+    """
+    if watermark is None:
+        return log_files
+
+    return [f for f in log_files
+            if f.modified > watermark['last_modified'] or
+            (f.modified == watermark['last_modified'] and f.path not in watermark['last_files'])]
+
+
+def extract_samples(target_dir):
+    """
+    Extracts the sample input files shipped in the data directory.
+    :param target_dir: directory where the song_data and log_data directories are created
+    :return: path to the extracted input files (to be used as input_data)
+    """
+    for archive_path, prefix in sample_archives():
+        with zipfile.ZipFile(archive_path) as z:
+            z.extractall(os.path.join(target_dir, prefix))
+    return 'file://' + os.path.abspath(target_dir) + '/'
+
+
+def sample_archives():
+    """
+    Lists the sample archives shipped in the data directory.
+    :return: list of tuples (path to the archive, prefix of its members), see archive.list_members
+    """
+    return [(os.path.join(DATA_DIR, name), prefix) for name, prefix in SAMPLE_ARCHIVES]
+
+
+def archive_inputs(args):
+    """
+    Lists the archives given in the command line.
+    :param args: argparse namespace
+    :return: list of tuples (path to the archive, prefix of its members) or None if the input is not archived
+    """
+    archives = sample_archives() if args.samples else []
+    for spec in args.archive:
+        path, _, prefix = spec.partition('=')
+        archives.append((path, prefix.rstrip('/') + '/' if prefix else ''))
+    return archives or None
+
+
+def compare_schema_inference(spark):
+    """
+    Compares the time to read the sample input files with an inferred schema and with the declared schemas.
+    Each read is forced with a no-op write so that every record is parsed.
+    :param spark: spark session
+    :return: None
+    """
+    input_data = extract_samples(tempfile.mkdtemp(prefix='sparkify_'))
+
+    for name, suffix, schema, columns in [('song_data', SONG_FILES_PATH_SUFFIX, SONG_SCHEMA, SONG_COLUMNS),
+                                          ('log_data', LOG_FILES_PATH_SUFFIX, LOG_SCHEMA, LOG_COLUMNS)]:
+        start = time.time()
+        spark.read.json(input_data + suffix).write.format('noop').mode('overwrite').save()
+        inferred = time.time() - start
+
+        start = time.time()
+        spark.read.schema(read_schema(schema, columns)).json(input_data + suffix) \
+            .write.format('noop').mode('overwrite').save()
+        declared = time.time() - start
+
+        logger.info('Source %s: inferred schema read in %.2fs, declared schema read in %.2fs',
+                    name, inferred, declared)
+
+
+def unpersist_sources(*dfs):
+    """
+    Releases the dataframes persisted by read_sources.
+    :param dfs: dataframes returned by read_sources
+    :return: None
+    """
+    for df in dfs:
+        df.unpersist()
+
+
+def epoch_ms_to_timestamp(ts):
+    """
+    Converts an epoch column in milliseconds to a timestamp column using a native Spark expression.
+    The time units extracted from it are in UTC as long as spark.sql.session.timeZone is UTC
+    (see create_spark_session).
+    :param ts: column with epoch time in milliseconds
+    :return: timestamp column
+    """
+    return (ts / 1000.0).cast(TimestampType())
+
+
+def derive_times(df, ts_column='ts'):
+    """
+    Breaks down each distinct epoch timestamp of a dataframe into time units.
+    Only JVM-native column expressions are used, so the rows never go through a Python worker
+    and each distinct timestamp is converted once.
+    :param df: dataframe with an epoch column in milliseconds
+    :param ts_column: name of the epoch column
+    :return: dataframe with columns start_time, datetime, hour, day, week, month, year and weekday
+    """
+    dt = epoch_ms_to_timestamp(col(ts_column))
+    return df.select(ts_column).distinct().select(col(ts_column).alias('start_time'),
+                                                  dt.alias('datetime'),
+                                                  hour(dt).alias('hour'),
+                                                  dayofmonth(dt).alias('day'),
+                                                  weekofyear(dt).alias('week'),
+                                                  month(dt).alias('month'),
+                                                  year(dt).alias('year'),
+                                                  date_format(dt, 'EEEE').alias('weekday'))
+
+
+def benchmark_time_derivation(spark, repeat=3):
+    """
+    Micro-benchmark of derive_times against the Python UDF previously used to convert the log timestamps.
+    Both versions run on the log sample shipped in the data directory and are forced with a no-op write.
+    :param spark: spark session
+    :param repeat: number of runs of each version
+    :return: None
+    """
+    input_data = extract_samples(tempfile.mkdtemp(prefix='sparkify_'))
+    log_df = spark.read.schema(read_schema(LOG_SCHEMA, ['ts'])).json(input_data + LOG_FILES_PATH_SUFFIX).cache()
+    log_df.count()
+
+    get_timestamp = udf(lambda z: datetime.utcfromtimestamp(float(z) / 1000.0), TimestampType())
+    udf_df = log_df.select('ts').distinct().withColumn('datetime', get_timestamp('ts'))
+    udf_df = udf_df.select(col('ts').alias('start_time'),
+                           col('datetime'),
+                           hour(col('datetime')).alias('hour'),
+                           dayofmonth(col('datetime')).alias('day'),
+                           weekofyear(col('datetime')).alias('week'),
+                           month(col('datetime')).alias('month'),
+                           year(col('datetime')).alias('year'),
+                           date_format(col('datetime'), 'EEEE').alias('weekday'))
+
+    for name, df in [('python udf', udf_df), ('native', derive_times(log_df))]:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            df.write.format('noop').mode('overwrite').save()
+            timings.append(time.time() - start)
+        logger.info('Time derivation (%s): best %.3fs, mean %.3fs over %d runs',
+                    name, min(timings), sum(timings) / len(timings), repeat)
+
+    log_df.unpersist()
+
+
+def physical_plan(df):
+    """
+    Returns the physical plan that Spark selected for a dataframe.
+    :param df: dataframe
+    :return: physical plan as a string
+    """
+    return df._jdf.queryExecution().executedPlan().toString()
+
+
+def salted_song_join(log_df, song_side, hot_keys, buckets=SKEW_SALT_BUCKETS):
+    """
+    Joins the log events to the songs spreading the hot (song, artist) keys over several partitions.
+    Events of hot keys get a deterministic salt in [0, buckets) and the matching songs are replicated once per salt.
+    The other events go through a regular shuffle join.
+    :param log_df: log events
+    :param song_side: songs pruned to the columns used by the join
+    :param hot_keys: dataframe with the song and artist columns of the hot keys
+    :param buckets: number of salts
+    :return: joined dataframe
+    """
+    hot_keys = broadcast(hot_keys)
+    hot_log = log_df.join(hot_keys, ['song', 'artist'], 'left_semi')
+    cold_log = log_df.join(hot_keys, ['song', 'artist'], 'left_anti')
+
+    salted_log = hot_log.withColumn('_salt', pmod(hash_('ts', 'sessionId', 'userId'), lit(buckets)))
+    salted_songs = song_side \
+        .join(hot_keys, (song_side['title'] == hot_keys['song']) & (song_side['artist_name'] == hot_keys['artist']),
+              'left_semi') \
+        .withColumn('_salt', explode(array([lit(i) for i in range(buckets)])))
+
+    hot_df = salted_log.join(salted_songs,
+                             (salted_songs['title'] == salted_log['song']) &
+                             (salted_songs['artist_name'] == salted_log['artist']) &
+                             (salted_songs['_salt'] == salted_log['_salt']))
+    cold_df = cold_log.join(song_side,
+                            (song_side['title'] == cold_log['song']) & (song_side['artist_name'] == cold_log['artist']))
+
+    columns = log_df.columns + ['song_id', 'artist_id']
+    return cold_df.select(*columns).unionByName(hot_df.select(*columns))
+
+
+def join_songs(log_df, song_df):
+    """
+    Joins the log events to the songs on title and artist name.
+    The song side is pruned to the columns used by the join and broadcast when its estimated size
+    is below SONG_BROADCAST_THRESHOLD. Otherwise the hot keys (more than SKEW_HOT_KEY_ROWS events) are salted.
+    The chosen strategy and the physical plan are logged.
+    :param log_df: log events
+    :param song_df: song dataset
+    :return: dataframe with the log columns plus song_id and artist_id
+    """
+    song_side = song_df.select('title', 'artist_name', 'song_id', 'artist_id')
+    song_size = estimated_size(song_side)
+
+    if song_size <= SONG_BROADCAST_THRESHOLD:
+        strategy = 'broadcast hash join'
+        df = log_df.join(broadcast(song_side),
+                         (song_side['title'] == log_df['song']) & (song_side['artist_name'] == log_df['artist']))
+        df = df.select(*(log_df.columns + ['song_id', 'artist_id']))
+    else:
+        hot_rows = log_df.groupBy('song', 'artist').count() \
+            .filter(col('count') > SKEW_HOT_KEY_ROWS) \
+            .select('song', 'artist') \
+            .collect()
+        # few keys have more than SKEW_HOT_KEY_ROWS events: they are sent back as a local relation, nothing is cached
+        hot_keys = log_df.sql_ctx.sparkSession.createDataFrame(hot_rows, log_df.select('song', 'artist').schema)
+        strategy = 'shuffle join with {} salted hot keys'.format(len(hot_rows))
+        df = salted_song_join(log_df, song_side, hot_keys)
+
+    logger.info('Songplays join strategy: %s (estimated song side: %d bytes)\n%s',
+                strategy, song_size, physical_plan(df))
+    return df
+
+
+@instrument
+def process_songs(spark, song_df, output_data):
+    """
+    Creates the dimension song dataset from the song dataset.
     The output dataset does not contain duplicated songs.
     The output dataset is saved in S3, it is partitioned by year/artist_id, it is in Parquet format
     and it overwrites the previous version of the dataset in S3 whenever this function is called.
     :param spark: spark session
-    :param input_data: path to the input files
+    :param song_df: song dataset
     :param output_data: path to the output files
     :return: None
     """
-    # read song data file
-    df = spark.read.json(input_data + SONG_FILES_PATH_SUFFIX)
-
     # extract columns to create songs table
-    songs_table = df.select('song_id', 'title', 'artist_id', 'year', 'duration').distinct()
+    songs_table = song_df.select('song_id', 'title', 'artist_id', 'year', 'duration').distinct()
 
     # write songs table to parquet files partitioned by year and artist
-    songs_table.write\
-        .partitionBy('year', 'artist_id')\
-        .mode('overwrite')\
-        .parquet(output_data + 'out_songs/songs.parquet')
+    table = OUTPUT_TABLES['songs']
+    write_table(songs_table, output_data + table.path, table.partition_by)
 
 
-def process_artists(spark, input_data, output_data):
+@instrument
+def process_artists(spark, song_df, output_data):
     """
-    Reads the songs dataset and generates the artists dimension dataset.
+    Generates the artists dimension dataset from the songs dataset.
     The output dataset does not contain duplicated artists.
     The output dataset is saved in S3, it is in Parquet format
     and it overwrites the previous version of the dataset in S3 whenever this function is called.
     :param spark: spark session
-    :param input_data: path to the input files
+    :param song_df: song dataset
     :param output_data: path to the output files
     :return: None
     """
-    # read song data file
-    df = spark.read.json(input_data + SONG_FILES_PATH_SUFFIX)
-
     # extract columns to create artists table
-    artists_table = df.select('artist_id', 'artist_name', 'artist_location', 'artist_latitude',
+    artists_table = song_df.select('artist_id', 'artist_name', 'artist_location', 'artist_latitude',
                               'artist_longitude').distinct()
 
     # write artists table to parquet files
-    artists_table.write.mode('overwrite').parquet(output_data + 'out_artists/artists.parquet')
+    write_table(artists_table, output_data + OUTPUT_TABLES['artists'].path)
 
 
-def process_users(spark, input_data, output_data):
+@instrument
+def process_users(spark, log_df, output_data, incremental=False):
     """
-    Reads the log dataset and generates the users dimension dataset.
+    Generates the users dimension dataset from the log dataset.
     The output dataset does not contain duplicated users.
     The output dataset is saved in S3, it is in Parquet format
     and it overwrites the previous version of the dataset in S3 whenever this function is called.
+    In incremental mode, only the users not present in the output dataset are appended to it.
     :param spark: spark session
-    :param input_data: path to the input files
+    :param log_df: log dataset
     :param output_data: path to the output files
+    :param incremental: merge the new users into the existing dataset instead of overwriting it
     :return: None
     """
-    # read log data file
-    df = spark.read.json(input_data + LOG_FILES_PATH_SUFFIX)
-
     # extract columns for users table
-    users_table = df.select('userId', 'firstName', 'lastName', 'gender', 'level').distinct()
+    users_table = log_df.select('userId', 'firstName', 'lastName', 'gender', 'level').distinct()
 
     # write users table to parquet files
-    users_table.write.mode('overwrite').parquet(output_data + 'out_users/users.parquet')
+    if incremental:
+        append_new_rows(spark, users_table, output_data + OUTPUT_TABLES['users'].path)
+    else:
+        write_table(users_table, output_data + OUTPUT_TABLES['users'].path)
 
 
-def process_times(spark, input_data, output_data):
+@instrument
+def process_times(spark, log_df, output_data, incremental=False):
     """
-    Reads the log dataset and generates the times dimension dataset.
+    Generates the times dimension dataset from the log dataset.
     The output dataset does not contain duplicated times.
     The output dataset is saved in S3, it is partitioned by year/month, it is in Parquet format
     and it overwrites the previous version of the dataset in S3 whenever this function is called.
+    In incremental mode, the times are merged into the existing dataset and only the affected
+    year/month partitions are rewritten.
     :param spark: spark session
-    :param input_data: path to the input files
+    :param log_df: log dataset
     :param output_data: path to the output files
+    :param incremental: merge into the affected partitions instead of overwriting the whole dataset
     :return: None
     """
-    # read song data file
-    df = spark.read.json(input_data + LOG_FILES_PATH_SUFFIX)
-
-    df = df.select('ts').distinct()
-
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda z: datetime.utcfromtimestamp(float(z) / 1000.0), TimestampType())
-    df = df.withColumn('datetime', get_timestamp('ts'))
-
     # extract columns to create time table
-    time_table = df.select(col("ts").alias('start_time'),
-                           hour(col("datetime")).alias("hour"),
-                           dayofmonth(col("datetime")).alias("day"),
-                           weekofyear(col("datetime")).alias("week"),
-                           month(col("datetime")).alias("month"),
-                           year(col("datetime")).alias("year"),
-                           date_format(col("datetime"), "EEEE").alias('weekday'))
+    time_table = derive_times(log_df).drop('datetime')
 
     # write time table to parquet files partitioned by year and month
-    time_table.write.mode('overwrite').partitionBy('year', 'month').parquet(output_data + 'out_times/times.parquet')
+    table = OUTPUT_TABLES['times']
+    if incremental:
+        upsert_partitions(spark, time_table, output_data + table.path, table.partition_by, ['start_time'],
+                          table.sort_by, table.stats_columns)
+    else:
+        write_table(time_table, output_data + table.path, table.partition_by, sort_by=table.sort_by)
+        record_file_statistics(spark, output_data + table.path, table.stats_columns)
 
 
-def process_songplays(spark, input_data, output_data):
+def song_plays(log_df):
     """
-    Reads the log dataset and generates the songplays fact dataset.
-    Each record in the output dataset is an user event in the music streaming app.
-    The output dataset is saved in S3, it is partitioned by year/month, it is in Parquet format
-    and it overwrites the previous version of the dataset in S3 whenever this function is called.
-    :param spark: spark session
-    :param input_data: path to the input files
-    :param output_data: path to the output files
-    :return: None
+    Keeps the log events that are song plays, the source of the songplays and sessions datasets.
+    :param log_df: log events
+    :return: dataframe
     """
-    # read log data file
-    log_df = spark.read.json(input_data + LOG_FILES_PATH_SUFFIX)
-    song_df = spark.read.json(input_data + SONG_FILES_PATH_SUFFIX)
+    return log_df.filter(col("page") == 'NextSong')
 
+
+def songplays_rows(log_df, song_df):
+    """
+    Builds the rows of the songplays fact dataset from log events and songs.
+    :param log_df: log events
+    :param song_df: song dataset
+    :return: dataframe with the columns of the songplays dataset
+    """
     # filter only song plays actions
-    log_df = log_df.filter(col("page") == 'NextSong')
+    log_df = song_plays(log_df)
 
     # join with songs table
-    df = log_df.join(song_df,
-                     (song_df['title'] == log_df['song']) & (song_df['artist_name'] == log_df['artist']))
-    df = df.select(log_df['*'], song_df['song_id'], song_df['artist_id'])
+    df = join_songs(log_df, song_df)
 
     # extract datetime from ts
-    get_timestamp = udf(lambda z: datetime.utcfromtimestamp(float(z) / 1000.0), TimestampType())
-    df = df.withColumn('datetime', get_timestamp('ts'))
+    df = df.withColumn('datetime', epoch_ms_to_timestamp(col('ts')))
 
-    df = df.withColumn("songplay_id", monotonically_increasing_id())
-    df = df.withColumn("year", year(col('datetime')))
-    df = df.withColumn("month", month(col('datetime')))
+    # deterministic id, so reprocessing an event replaces it instead of adding a copy
+    df = df.withColumn("songplay_id", md5(concat_ws('|', *[col(c).cast('string') for c in SONGPLAY_KEY_COLUMNS])))
 
-    songplays_table = df.select(
+    return df.select(
         col('songplay_id'),
         col('ts').alias('start_time'),
         year(col('datetime')).alias('year'),
@@ -175,32 +793,501 @@ def process_songplays(spark, input_data, output_data):
         col('location'),
         col('userAgent').alias('user_agent'))
 
+
+@instrument
+def process_songplays(spark, log_df, song_df, output_data, incremental=False):
+    """
+    Generates the songplays fact dataset from the log and song datasets.
+    Each record in the output dataset is an user event in the music streaming app.
+    The output dataset is saved in S3, it is partitioned by year/month, it is in Parquet format
+    and it overwrites the previous version of the dataset in S3 whenever this function is called.
+    The songplay_id is derived from the event attributes, so it does not change when an event is reprocessed.
+    In incremental mode, new or changed events are merged into the existing dataset and only the affected
+    year/month partitions are rewritten.
+    :param spark: spark session
+    :param log_df: log dataset
+    :param song_df: song dataset
+    :param output_data: path to the output files
+    :param incremental: merge into the affected partitions instead of overwriting the whole dataset
+    :return: None
+    """
+    table = OUTPUT_TABLES['songplays']
+    songplays_path = output_data + table.path
+    songplays_table = songplays_rows(log_df, song_df)
+
     # write songplays table to parquet files partitioned by year and month
-    songplays_table \
-        .write \
-        .mode('overwrite') \
-        .partitionBy('year', 'month') \
-        .parquet(output_data + 'out_songplays/songplays.parquet')
+    if incremental:
+        directories = upsert_partitions(spark, songplays_table, songplays_path, table.partition_by, ['songplay_id'],
+                                        table.sort_by, table.stats_columns)
+        build_index(spark, songplays_path, table.partition_by, table.index, directories)
+    else:
+        write_table(songplays_table, songplays_path, table.partition_by, sort_by=table.sort_by)
+        record_file_statistics(spark, songplays_path, table.stats_columns)
+        build_index(spark, songplays_path, table.partition_by, table.index)
+
+
+def session_rows(log_df):
+    """
+    Aggregates the song plays of each user session.
+    The level changes are counted between consecutive song plays ordered by ts and itemInSession.
+    :param log_df: log events
+    :return: dataframe with the columns of the sessions dataset
+    """
+    window = Window.partitionBy('sessionId', 'userId').orderBy('ts', 'itemInSession')
+    df = song_plays(log_df) \
+        .withColumn('previous_level', lag('level').over(window)) \
+        .withColumn('next_level', lead('level').over(window))
+
+    sessions = df.groupBy(col('sessionId').alias('session_id'), col('userId').alias('user_id')).agg(
+        min_('ts').alias('start_time'),
+        max_('ts').alias('end_time'),
+        count(lit(1)).alias('songs'),
+        sum_(when(col('level') == 'paid', 1).otherwise(0)).alias('paid_songs'),
+        sum_(when(col('previous_level') != col('level'), 1).otherwise(0)).alias('level_changes'),
+        first(when(col('previous_level').isNull(), col('level')), ignorenulls=True).alias('first_level'),
+        first(when(col('next_level').isNull(), col('level')), ignorenulls=True).alias('last_level'))
+
+    start = epoch_ms_to_timestamp(col('start_time'))
+    return sessions.withColumn('year', year(start)).withColumn('month', month(start))
+
+
+def merge_sessions(existing, sessions):
+    """
+    Merges new session aggregates with the existing ones of the same sessions.
+    A session whose new song plays are all after (or all before) the existing ones continues in the new log files,
+    so both aggregates are combined. A session whose new song plays are within the range of the existing ones was
+    already loaded (a rerun of some of its log files) and is kept. Otherwise the new aggregate replaces the existing
+    one. A merged session stays in the year/month partition of the existing row.
+    :param existing: sessions dataset written by previous runs
+    :param sessions: sessions aggregated from the new log files
+    :return: dataframe with the columns of the sessions dataset
+    """
+    e = existing.join(sessions.select(*SESSION_KEY_COLUMNS), SESSION_KEY_COLUMNS, 'left_semi').alias('e')
+    n = sessions.alias('n')
+    df = n.join(e, SESSION_KEY_COLUMNS, 'left')
+
+    after = col('e.end_time') < col('n.start_time')
+    before = col('n.end_time') < col('e.start_time')
+    combine = col('e.start_time').isNotNull() & (after | before)
+    keep = (col('e.start_time') <= col('n.start_time')) & (col('n.end_time') <= col('e.end_time'))
+    earlier_level = when(after, col('e.last_level')).otherwise(col('n.last_level'))
+    later_level = when(after, col('n.first_level')).otherwise(col('e.first_level'))
+
+    def merged(name, combined):
+        return when(combine, combined).when(keep, col('e.' + name)).otherwise(col('n.' + name)).alias(name)
+
+    columns = SESSION_KEY_COLUMNS + [
+        merged('start_time', when(after, col('e.start_time')).otherwise(col('n.start_time'))),
+        merged('end_time', when(after, col('n.end_time')).otherwise(col('e.end_time'))),
+        merged('songs', col('e.songs') + col('n.songs')),
+        merged('paid_songs', col('e.paid_songs') + col('n.paid_songs')),
+        merged('level_changes', col('e.level_changes') + col('n.level_changes') +
+               when(earlier_level != later_level, 1).otherwise(0)),
+        merged('first_level', when(after, col('e.first_level')).otherwise(col('n.first_level'))),
+        merged('last_level', when(after, col('n.last_level')).otherwise(col('e.last_level'))),
+        when(col('e.year').isNotNull(), col('e.year')).otherwise(col('n.year')).alias('year'),
+        when(col('e.month').isNotNull(), col('e.month')).otherwise(col('n.month')).alias('month')]
+    return df.select(*columns)
+
+
+def session_months(sessions):
+    """
+    Lists the year/month partitions of the sessions dataset that can hold an existing row of the given sessions:
+    the months of their start plus the month before (a session continuing from the previous month stays in the
+    partition of its existing start) and the month after (new song plays before the existing ones, see merge_sessions).
+    :param sessions: sessions aggregated from the new log files
+    :return: list of dicts with the keys year and month
+    """
+    months = set()
+    for p in sessions.select('year', 'month').distinct().collect():
+        index = p['year'] * 12 + p['month'] - 1
+        months.update([index - 1, index, index + 1])
+    return [{'year': m // 12, 'month': m % 12 + 1} for m in sorted(months)]
+
+
+@instrument
+def process_sessions(spark, log_df, output_data, incremental=False):
+    """
+    Generates the sessions dataset from the log dataset: one record per user session with its first and
+    last song play, the number of song plays (all and paid) and the number of level changes.
+    The output dataset is saved in S3, it is partitioned by year/month of the session start, it is in Parquet format
+    and it overwrites the previous version of the dataset in S3 whenever this function is called.
+    In incremental mode, the sessions are merged into the existing dataset (see merge_sessions) and only the
+    affected year/month partitions are rewritten.
+    :param spark: spark session
+    :param log_df: log dataset
+    :param output_data: path to the output files
+    :param incremental: merge into the affected partitions instead of overwriting the whole dataset
+    :return: None
+    """
+    table = OUTPUT_TABLES['sessions']
+    sessions_path = output_data + table.path
+    sessions_table = session_rows(log_df)
+
+    # write sessions table to parquet files partitioned by year and month
+    if incremental:
+        existing = read_existing(spark, sessions_path)
+        if existing is not None:
+            # only the partitions that can hold the new sessions are read
+            existing = existing.filter(partition_filter(session_months(sessions_table), table.partition_by))
+            sessions_table = merge_sessions(existing, sessions_table)
+        upsert_partitions(spark, sessions_table, sessions_path, table.partition_by, SESSION_KEY_COLUMNS,
+                          table.sort_by)
+    else:
+        write_table(sessions_table, sessions_path, table.partition_by, sort_by=table.sort_by)
+
+
+def process_song_data(spark, song_df, output_data):
+    process_songs(spark, song_df, output_data)
+    process_artists(spark, song_df, output_data)
+
 
+def process_log_data(spark, log_df, song_df, output_data, incremental=False):
+    process_users(spark, log_df, output_data, incremental)
+    process_times(spark, log_df, output_data, incremental)
+    process_songplays(spark, log_df, song_df, output_data, incremental)
+    process_sessions(spark, log_df, output_data, incremental)
 
-def process_song_data(spark, input_data, output_data):
-    process_songs(spark, input_data, output_data)
-    process_artists(spark, input_data, output_data)
 
+def table_builds(spark, song_df, log_df, output_data, incremental=False):
+    """
+    Lists the builds of the output tables of a run. They only share the persisted source dataframes,
+    so they can run in any order or at the same time.
+    :param spark: spark session
+    :param song_df: song dataset
+    :param log_df: log dataset
+    :param output_data: path to the output files
+    :param incremental: merge the log tables instead of rewriting them (the song tables are skipped)
+    :return: list of tuples (table name, process_* function, arguments)
+    """
+    builds = []
+    if not incremental:
+        builds.append(('songs', process_songs, (spark, song_df, output_data)))
+        builds.append(('artists', process_artists, (spark, song_df, output_data)))
+    builds.append(('users', process_users, (spark, log_df, output_data, incremental)))
+    builds.append(('times', process_times, (spark, log_df, output_data, incremental)))
+    builds.append(('songplays', process_songplays, (spark, log_df, song_df, output_data, incremental)))
+    builds.append(('sessions', process_sessions, (spark, log_df, output_data, incremental)))
+    return builds
+
+
+def table_markers(inputs):
+    """
+    Builds the expected completion markers of the output tables of a full run.
+    :param inputs: dict input name ('song_data' or 'log_data') -> list of FileStatus or archive.Member read by the run
+    :return: dict table name -> marker (see markers.stage_marker)
+    """
+    return dict((name, stage_marker(repr(table), dict((source, inputs[source]) for source in TABLE_INPUTS[name])))
+                for name, table in OUTPUT_TABLES.items())
+
+
+def completed_tables(spark, output_data, expected, rebuild=None):
+    """
+    Lists the tables that a resumed run can skip: their saved marker matches the expected one
+    (same input files, sizes and modification times and same code version) and they are not forced to be rebuilt.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :param expected: dict table name -> marker, see table_markers
+    :param rebuild: names of the tables rebuilt anyway
+    :return: set of table names
+    """
+    completed = set()
+    for name, marker in expected.items():
+        if name in (rebuild or []):
+            logger.info('Table %s: rebuild forced', name)
+        elif is_complete(spark, output_data, name, output_data + OUTPUT_TABLES[name].path, marker):
+            logger.info('Table %s: up to date, skipped', name)
+            completed.add(name)
+    return completed
+
+
+def run_sequential(builds):
+    """
+    Runs the table builds one after another. The first failure stops the run.
+    :param builds: list of tuples (table name, process_* function, arguments), see table_builds
+    :return: wall time in seconds
+    """
+    start = time.time()
+    for name, func, args in builds:
+        with building(name):
+            func(*args)
+
+    wall_time = time.time() - start
+    logger.info('Built %d tables sequentially in %.2f s', len(builds), wall_time)
+    return wall_time
+
+
+def run_concurrent(spark, builds, max_workers=None):
+    """
+    Runs the table builds at the same time from a thread pool. The jobs of each table are submitted
+    to its own FAIR scheduler pool (named after the table), so a table waiting on the driver
+    does not leave the executors idle and a large table does not starve the small ones.
+    A failed table does not stop the others; the failures are raised together at the end.
+    The session must use the FAIR scheduler (see create_spark_session).
+    :param spark: spark session
+    :param builds: list of tuples (table name, process_* function, arguments), see table_builds
+    :param max_workers: maximum number of tables built at the same time (all of them by default)
+    :return: wall time in seconds
+    """
+    sc = spark.sparkContext
+
+    def build(name, func, args):
+        # the active session is per JVM thread, adaptive query plans need it
+        sc._jvm.org.apache.spark.sql.SparkSession.setActiveSession(spark._jsparkSession)
+        sc.setLocalProperty('spark.scheduler.pool', name)
+        try:
+            table_start = time.time()
+            with building(name):
+                func(*args)
+            return time.time() - table_start
+        finally:
+            sc.setLocalProperty('spark.scheduler.pool', None)
+
+    start = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers or len(builds)) as pool:
+        futures = dict((pool.submit(build, name, func, args), name) for name, func, args in builds)
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                logger.info('Table %s built in %.2f s', name, future.result())
+            except Exception:
+                logger.exception('Table %s failed', name)
+                failed.append(name)
+
+    wall_time = time.time() - start
+    logger.info('Built %d tables concurrently in %.2f s (%d failed)', len(builds), wall_time, len(failed))
+    if failed:
+        raise RuntimeError('Could not build the tables: {}'.format(', '.join(sorted(failed))))
+    return wall_time
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Sparkify data lake ETL')
+    parser.add_argument('--compare-schema-inference', action='store_true',
+                        help='compare inferred vs declared schema read time on the samples in data/ and exit')
+    parser.add_argument('--benchmark-time', action='store_true',
+                        help='compare the native time derivation with the python UDF on the log sample and exit')
+    parser.add_argument('--compact', action='store_true',
+                        help='rewrite the small files of the existing output datasets and exit')
+    parser.add_argument('--metrics-file',
+                        help='local file where the Spark metrics of each process_* function are written')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='format of the metrics file: JSON lines or Prometheus textfile')
+    parser.add_argument('--plans-dir',
+                        help='local directory where the physical plans of the table builds are saved '
+                             '(compare two runs with plans.py)')
+    parser.add_argument('--plans-version',
+                        help='name of the subdirectory of --plans-dir of this run (UTC time of the run by default)')
+    parser.add_argument('--profile', choices=sorted(SESSION_PROFILES) + ['auto'],
+                        help='spark session profile, auto chooses it from the location and size of the input '
+                             '(Spark defaults if not given)')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='build the output tables at the same time, each one in its own FAIR scheduler pool')
+    parser.add_argument('--sort-by', action='append', default=[], metavar='TABLE=COL1,COL2',
+                        help='columns used to sort the rows of songplays or times within each partition '
+                             '(an empty list disables the sort)')
+    parser.add_argument('--engine', choices=['spark', 'local', 'auto'], default='spark',
+                        help='engine of full runs: spark, local (pyarrow/pandas on this machine) or auto '
+                             '(local when the input is smaller than local_engine.LOCAL_ENGINE_MAX_BYTES)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='process only the log files newer than the watermark of the last run')
+    parser.add_argument('--upsert', action='store_true',
+                        help='merge the log files matching --log-pattern into the existing log tables')
+    parser.add_argument('--log-pattern', default=LOG_FILES_PATH_SUFFIX,
+                        help='glob of the log files, relative to the input path (e.g. log_data/2018-11-05-*.json)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the tables whose inputs and code did not change since their last successful build')
+    parser.add_argument('--rebuild', action='append', default=[], choices=sorted(OUTPUT_TABLES), metavar='TABLE',
+                        help='build this table even if --resume would skip it (can be repeated)')
+    parser.add_argument('--refresh-manifest', action='store_true',
+                        help='list all the input files again instead of only the prefixes changed since the last run')
+    parser.add_argument('--samples', action='store_true',
+                        help='read the input from the sample archives in data/ without extracting them')
+    parser.add_argument('--archive', action='append', default=[], metavar='PATH[=PREFIX]',
+                        help='read the input from a local zip or tar.gz archive without extracting it; PREFIX is '
+                             'the directory its members belong to, relative to the input path (e.g. =log_data)')
+    args = parser.parse_args()
+
+    if args.engine == 'local' and spark_only(args):
+        parser.error('--engine local supports full runs only')
+    if args.resume and (args.incremental or args.upsert):
+        parser.error('--resume supports full runs only')
+    return args
+
+
+def apply_sort_options(specs):
+    """
+    Changes the columns used to sort the rows of the output datasets within each partition.
+    :param specs: list of strings such as 'songplays=user_id,start_time'
+    :return: None
+    """
+    for spec in specs:
+        name, _, columns = spec.partition('=')
+        if name not in OUTPUT_TABLES:
+            raise ValueError('Unknown table in --sort-by: {}'.format(name))
+        sort_by = [c.strip() for c in columns.split(',') if c.strip()]
+        OUTPUT_TABLES[name] = OUTPUT_TABLES[name]._replace(sort_by=sort_by)
+        logger.info('Rows of %s sorted by %s', name, sort_by)
+
+
+def spark_only(args):
+    """
+    Checks if the command line asks for features available in the Spark engine only.
+    :param args: argparse namespace
+    :return: True if the Spark engine is required
+    """
+    return bool(args.compare_schema_inference or args.benchmark_time or args.compact or args.metrics_file or
+                args.incremental or args.upsert or args.sort_by or args.concurrent or args.profile or
+                args.resume or args.rebuild or args.refresh_manifest or args.plans_dir or
+                args.log_pattern != LOG_FILES_PATH_SUFFIX)
+
+
+def use_local_engine(args, input_data, archives=None):
+    """
+    Chooses the engine of the run.
+    :param args: argparse namespace
+    :param input_data: path to the input files
+    :param archives: archives the input files are read from, instead of input_data (see archive_inputs)
+    :return: True if the run uses local_engine instead of Spark
+    """
+    if args.engine == 'local':
+        return True
+    if args.engine == 'spark' or spark_only(args):
+        return False
+
+    try:
+        import local_engine
+        size = local_engine.input_size(input_data, archives)
+    except Exception:
+        logger.exception('Could not measure the input size, using spark')
+        return False
 
-def process_log_data(spark, input_data, output_data):
-    process_users(spark, input_data, output_data)
-    process_times(spark, input_data, output_data)
-    process_songplays(spark, input_data, output_data)
+    logger.info('Input size: %d bytes', size)
+    return size <= local_engine.LOCAL_ENGINE_MAX_BYTES
+
+
+def run_local_engine(input_data, output_data, archives=None):
+    """
+    Runs the full ETL with the pyarrow/pandas engine.
+    :param input_data: path to the input files
+    :param output_data: path to the output files
+    :param archives: archives the input files are read from, instead of input_data (see archive_inputs)
+    :return: None
+    """
+    import local_engine
+
+    song_df, log_df = local_engine.read_sources(input_data, output_data, archives)
+    local_engine.process_song_data(song_df, output_data)
+    local_engine.process_log_data(log_df, song_df, output_data)
 
 
 def main():
-    spark = create_spark_session()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    args = parse_args()
+
     input_data = S3_PATH
     output_data = S3_PATH
 
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    archives = archive_inputs(args)
+
+    if use_local_engine(args, input_data, archives):
+        logger.info('Running with the local engine')
+        run_local_engine(input_data, output_data, archives)
+        return
+
+    apply_sort_options(args.sort_by)
+    profile = choose_profile(input_data, archives) if args.profile == 'auto' else args.profile
+    s3 = (not archives and not is_local_path(input_data)) or not is_local_path(output_data)
+
+    start = time.time()
+    spark = create_spark_session('FAIR' if args.concurrent else 'FIFO', profile, s3)
+    try:
+        run_spark(spark, args, input_data, output_data, archives)
+    finally:
+        logger.info('Run with profile %s finished in %.2f s', profile or 'default', time.time() - start)
+
+
+def run_spark(spark, args, input_data, output_data, archives=None):
+    """
+    Runs the command chosen in the command line with the Spark engine.
+    :param spark: spark session
+    :param args: argparse namespace
+    :param input_data: path to the input files
+    :param output_data: path to the output files
+    :param archives: archives the input files are read from, instead of input_data (see archive_inputs)
+    :return: None
+    """
+    if args.compare_schema_inference:
+        compare_schema_inference(spark)
+        return
+    if args.benchmark_time:
+        benchmark_time_derivation(spark)
+        return
+    if args.compact:
+        for table in OUTPUT_TABLES.values():
+            compact_dataset(spark, output_data + table.path, table)
+            record_file_statistics(spark, output_data + table.path, table.stats_columns)
+            build_index(spark, output_data + table.path, table.partition_by, table.index)
+        return
+
+    if archives:
+        song_files = archive.list_members(archives, SONG_FILES_PATH_SUFFIX)
+        log_files = archive.list_members(archives, args.log_pattern)
+    else:
+        # a file rewritten in place keeps the modification time of its directory, so the cached sizes and
+        # modification times can be stale: the fingerprints of --resume and the watermark of --incremental
+        # are computed from a fresh listing
+        refresh = args.refresh_manifest or args.resume or args.incremental
+        song_files = manifest_files(spark, input_data, output_data, 'song_data', SONG_FILES_PATH_SUFFIX, refresh)
+        log_files = list_log_files(spark, input_data, output_data, args.log_pattern, refresh)
+    if not log_files:
+        logger.info('No log files match %s', args.log_pattern)
+        return
+    if args.incremental:
+        log_files = new_log_files(log_files, read_watermark(spark, output_data))
+        if not log_files:
+            logger.info('No new log files since the last run')
+            return
+        logger.info('Incremental run: %d new log files', len(log_files))
+
+    # the tables merged by incremental and upsert runs no longer match the fingerprint of a single run,
+    # so these runs only remove their markers
+    merge = args.incremental or args.upsert
+    expected = {} if merge else table_markers({'song_data': song_files, 'log_data': log_files})
+    completed = completed_tables(spark, output_data, expected, args.rebuild) if args.resume else set()
+    if len(completed) == len(OUTPUT_TABLES):
+        logger.info('All tables are up to date')
+        return
+
+    recorder = MetricsRecorder(spark).activate() if args.metrics_file else None
+    plan_recorder = PlanRecorder(args.plans_dir, args.plans_version).activate() if args.plans_dir else None
+    try:
+        song_df, log_df = read_sources(spark, input_data, output_data, log_files=log_files, song_files=song_files)
+        try:
+            # the song dataset is not tracked by the watermark, song tables are rebuilt by full runs only
+            builds = [(name, tracked(spark, output_data, name, func, expected.get(name)), func_args)
+                      for name, func, func_args in table_builds(spark, song_df, log_df, output_data, merge)
+                      if name not in completed]
+            if args.concurrent:
+                run_concurrent(spark, builds)
+            else:
+                run_sequential(builds)
+            # an upsert of older files must not move the watermark back
+            if not args.upsert:
+                write_watermark(spark, output_data, log_files, log_df)
+        finally:
+            unpersist_sources(song_df, log_df)
+    finally:
+        if recorder:
+            recorder.write(args.metrics_file, args.metrics_format)
+        if plan_recorder:
+            plan_recorder.write({'spark_version': spark.version, 'log_pattern': args.log_pattern,
+                                 'incremental': args.incremental, 'upsert': args.upsert})
 
 
 if __name__ == "__main__":
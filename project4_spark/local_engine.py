@@ -0,0 +1,401 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import fnmatch
+import hashlib
+import logging
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.json as pajson
+import pyarrow.parquet as pq
+from pyspark.sql.types import StringType, LongType, DoubleType
+
+import archive
+import etl
+from markers import marker_path
+
+# inputs smaller than this (bytes) are processed by this engine when the engine is chosen automatically
+LOCAL_ENGINE_MAX_BYTES = 512 * 1024 * 1024
+# number of files parsed at the same time
+READ_THREADS = 16
+
+ARROW_TYPES = {
+    StringType(): pa.string(),
+    LongType(): pa.int64(),
+    DoubleType(): pa.float64()
+}
+
+logger = logging.getLogger(__name__)
+
+
+def resolve(uri):
+    """
+    Resolves a path of etl.py (local, file:// or s3a://) to a pyarrow file system.
+    :param uri: path or URI
+    :return: tuple (pyarrow FileSystem, path in the file system)
+    """
+    if uri.startswith('s3a://'):
+        uri = 's3://' + uri[len('s3a://'):]
+    if '://' not in uri:
+        return pafs.LocalFileSystem(), uri
+    return pafs.FileSystem.from_uri(uri)
+
+
+def list_files(input_data, pattern):
+    """
+    Lists the files matching a glob pattern, such as etl.SONG_FILES_PATH_SUFFIX.
+    Every level of the pattern matches exactly one level of directories.
+    :param input_data: path to the input files
+    :param pattern: glob pattern relative to input_data
+    :return: tuple (pyarrow FileSystem, list of pyarrow FileInfo)
+    """
+    fs, base = resolve(input_data)
+    base = base.rstrip('/')
+    segments = pattern.split('/')
+
+    # list recursively from the deepest directory without wildcards
+    fixed = []
+    for s in segments[:-1]:
+        if any(c in s for c in '*?['):
+            break
+        fixed.append(s)
+    root = '/'.join([base] + fixed)
+
+    infos = fs.get_file_info(pafs.FileSelector(root, recursive=True, allow_not_found=True))
+    matches = []
+    for info in infos:
+        if info.type != pafs.FileType.File:
+            continue
+        parts = info.path[len(base) + 1:].split('/')
+        if len(parts) == len(segments) and all(fnmatch.fnmatchcase(p, s) for p, s in zip(parts, segments)):
+            matches.append(info)
+
+    return fs, sorted(matches, key=lambda i: i.path)
+
+
+def input_size(input_data, archives=None):
+    """
+    Computes the size of the song and log input files.
+    :param input_data: path to the input files
+    :param archives: archives the input files are read from, instead of input_data (see etl.archive_inputs)
+    :return: number of bytes
+    """
+    total = 0
+    for pattern in [etl.SONG_FILES_PATH_SUFFIX, etl.LOG_FILES_PATH_SUFFIX]:
+        if archives:
+            files = archive.list_members(archives, pattern)
+        else:
+            _, files = list_files(input_data, pattern)
+        total += sum(f.size for f in files)
+    return total
+
+
+def arrow_schema(schema, columns):
+    """
+    Converts the declared Spark schema of an input dataset to a pyarrow schema with the given columns.
+    :param schema: StructType with the full record layout
+    :param columns: names of the columns to be read
+    :return: pyarrow schema
+    """
+    return pa.schema([(f.name, ARROW_TYPES[f.dataType]) for f in schema.fields if f.name in columns])
+
+
+def parse_json(content, schema):
+    """
+    Parses JSON lines with a declared schema. When the content does not parse, it is parsed line by line
+    and the malformed lines are returned instead of failing the whole file, like the PERMISSIVE mode of Spark.
+    :param content: bytes
+    :param schema: pyarrow schema of the records
+    :return: tuple (pyarrow Table, list of malformed lines)
+    """
+    parse_options = pajson.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+    try:
+        return pajson.read_json(pa.BufferReader(content), parse_options=parse_options), []
+    except pa.ArrowInvalid:
+        pass
+
+    tables, corrupt = [schema.empty_table()], []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            tables.append(pajson.read_json(pa.BufferReader(line), parse_options=parse_options))
+        except pa.ArrowInvalid:
+            corrupt.append(line.decode('utf-8', 'replace'))
+    return pa.concat_tables(tables), corrupt
+
+
+def quarantine(name, corrupt, schema, output_data, run_id):
+    """
+    Appends malformed records to the quarantine dataset, in the same layout as etl.read_source: the columns of
+    the records (null), the corrupt record column with the line and the run_id partition.
+    :param name: name of the dataset
+    :param corrupt: list of malformed lines
+    :param schema: pyarrow schema of the records
+    :param output_data: path to the output files
+    :param run_id: partition of the quarantine dataset
+    :return: None
+    """
+    logger.warning('Source %s: %d malformed records moved to quarantine', name, len(corrupt))
+    columns = [pa.nulls(len(corrupt), f.type) for f in schema] + \
+        [pa.array(corrupt, pa.string()), pa.array([run_id] * len(corrupt), pa.string())]
+    names = schema.names + [etl.CORRUPT_RECORD_COLUMN, etl.QUARANTINE_PARTITION_COLUMN]
+
+    fs, path = resolve(output_data + etl.QUARANTINE_PATH_SUFFIX + name)
+    pq.write_to_dataset(pa.Table.from_arrays(columns, names=names), path,
+                        partition_cols=[etl.QUARANTINE_PARTITION_COLUMN], filesystem=fs)
+
+
+def concat_parsed(name, parsed, schema, output_data, run_id):
+    """
+    Concatenates the records parsed from the files of a dataset and quarantines the malformed ones.
+    :param name: name of the dataset
+    :param parsed: list of tuples returned by parse_json
+    :param schema: pyarrow schema of the records
+    :param output_data: path to the output files
+    :param run_id: partition of the quarantine dataset
+    :return: pyarrow Table
+    """
+    corrupt = [line for _, lines in parsed for line in lines]
+    if corrupt:
+        quarantine(name, corrupt, schema, output_data, run_id)
+    if not parsed:
+        return schema.empty_table()
+    return pa.concat_tables([table for table, _ in parsed])
+
+
+def read_source(name, input_data, pattern, schema, output_data, run_id):
+    """
+    Reads the JSON files of an input dataset in parallel. Malformed records are appended to the quarantine
+    dataset (see quarantine) and removed from the returned table.
+    :param name: name of the dataset
+    :param input_data: path to the input files
+    :param pattern: glob pattern relative to input_data
+    :param schema: pyarrow schema of the records
+    :param output_data: path to the output files
+    :param run_id: partition of the quarantine dataset
+    :return: pyarrow Table
+    """
+    fs, files = list_files(input_data, pattern)
+
+    def read(info):
+        with fs.open_input_stream(info.path) as stream:
+            return parse_json(stream.read(), schema)
+
+    with ThreadPoolExecutor(READ_THREADS) as pool:
+        parsed = list(pool.map(read, files))
+
+    logger.info('Source %s: read %d files (%d bytes)', name, len(files), sum(f.size for f in files))
+    return concat_parsed(name, parsed, schema, output_data, run_id)
+
+
+def read_archive_source(name, archives, pattern, schema, output_data, run_id):
+    """
+    Reads the JSON members of an input dataset stored in archives, without extracting them to disk.
+    Malformed records are quarantined as in read_source.
+    :param name: name of the dataset
+    :param archives: list of tuples (path to the archive, prefix of its members), see archive.list_members
+    :param pattern: glob pattern relative to input_data
+    :param schema: pyarrow schema of the records
+    :param output_data: path to the output files
+    :param run_id: partition of the quarantine dataset
+    :return: pyarrow Table
+    """
+    members = archive.list_members(archives, pattern)
+
+    with ThreadPoolExecutor(READ_THREADS) as pool:
+        parsed = list(pool.map(lambda content: parse_json(content, schema), archive.read_members(members)))
+
+    logger.info('Source %s: read %d archive members (%d bytes)', name, len(members), sum(m.size for m in members))
+    return concat_parsed(name, parsed, schema, output_data, run_id)
+
+
+def read_sources(input_data, output_data, archives=None):
+    """
+    Reads the song and log datasets with the columns used by the ETL.
+    :param input_data: path to the input files
+    :param output_data: path to the output files (malformed records are quarantined there)
+    :param archives: archives the input files are read from, instead of input_data (see etl.archive_inputs)
+    :return: tuple (song pandas dataframe, log pandas dataframe)
+    """
+    run_id = datetime.utcnow().strftime(etl.RUN_ID_FORMAT)
+    song_schema = arrow_schema(etl.SONG_SCHEMA, etl.SONG_COLUMNS)
+    log_schema = arrow_schema(etl.LOG_SCHEMA, etl.LOG_COLUMNS)
+    if archives:
+        song_table = read_archive_source('song_data', archives, etl.SONG_FILES_PATH_SUFFIX, song_schema,
+                                         output_data, run_id)
+        log_table = read_archive_source('log_data', archives, etl.LOG_FILES_PATH_SUFFIX, log_schema,
+                                        output_data, run_id)
+    else:
+        song_table = read_source('song_data', input_data, etl.SONG_FILES_PATH_SUFFIX, song_schema, output_data, run_id)
+        log_table = read_source('log_data', input_data, etl.LOG_FILES_PATH_SUFFIX, log_schema, output_data, run_id)
+    # integer columns with nulls are kept as python ints instead of being converted to floats
+    return song_table.to_pandas(), log_table.to_pandas(integer_object_nulls=True)
+
+
+def write_table(df, output_data, name):
+    """
+    Writes an output dataset in the same Parquet layout written by etl.py, replacing the previous version.
+    The completion marker of the table is deleted first: the sidecar files of etl.py (file statistics, index)
+    and its sort order are not written here, so a --resume run of etl.py builds the table again.
+    :param df: pandas dataframe
+    :param output_data: path to the output files
+    :param name: name of the table in etl.OUTPUT_TABLES
+    :return: None
+    """
+    marker_fs, marker = resolve(marker_path(output_data, name))
+    if marker_fs.get_file_info(marker).type != pafs.FileType.NotFound:
+        marker_fs.delete_file(marker)
+
+    table = etl.OUTPUT_TABLES[name]
+    fs, path = resolve(output_data + table.path)
+    if fs.get_file_info(path).type != pafs.FileType.NotFound:
+        fs.delete_dir(path)
+    fs.create_dir(path)
+
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), path,
+                        partition_cols=table.partition_by or None, filesystem=fs)
+
+
+def process_songs(song_df, output_data):
+    """
+    Creates the dimension song dataset from the song dataset.
+    :param song_df: song dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    songs_table = song_df[['song_id', 'title', 'artist_id', 'year', 'duration']].drop_duplicates()
+    write_table(songs_table, output_data, 'songs')
+
+
+def process_artists(song_df, output_data):
+    """
+    Generates the artists dimension dataset from the songs dataset.
+    :param song_df: song dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    artists_table = song_df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude',
+                             'artist_longitude']].drop_duplicates()
+    write_table(artists_table, output_data, 'artists')
+
+
+def process_users(log_df, output_data):
+    """
+    Generates the users dimension dataset from the log dataset.
+    :param log_df: log dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    users_table = log_df[['userId', 'firstName', 'lastName', 'gender', 'level']].drop_duplicates()
+    write_table(users_table, output_data, 'users')
+
+
+def process_times(log_df, output_data):
+    """
+    Generates the times dimension dataset from the log dataset.
+    The time units are extracted in UTC, as in etl.derive_times.
+    :param log_df: log dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    ts = pd.Series(log_df['ts'].dropna().unique()).astype('int64')
+    dt = pd.to_datetime(ts, unit='ms')
+
+    time_table = pd.DataFrame({
+        'start_time': ts,
+        'hour': dt.dt.hour.astype('int32'),
+        'day': dt.dt.day.astype('int32'),
+        'week': dt.dt.isocalendar().week.astype('int32'),
+        'month': dt.dt.month.astype('int32'),
+        'year': dt.dt.year.astype('int32'),
+        'weekday': dt.dt.day_name()
+    })
+    write_table(time_table, output_data, 'times')
+
+
+def songplay_ids(df):
+    """
+    Computes the songplay_id of each event exactly like etl.process_songplays:
+    MD5 of the key columns cast to string and joined with '|', skipping nulls.
+    :param df: pandas dataframe with the etl.SONGPLAY_KEY_COLUMNS columns
+    :return: list of ids
+    """
+    rows = zip(*[df[c] for c in etl.SONGPLAY_KEY_COLUMNS])
+    keys = ['|'.join(str(v) for v in row if v is not None and v == v) for row in rows]
+    return [hashlib.md5(k.encode('utf-8')).hexdigest() for k in keys]
+
+
+def process_songplays(log_df, song_df, output_data):
+    """
+    Generates the songplays fact dataset from the log and song datasets.
+    :param log_df: log dataset
+    :param song_df: song dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    df = log_df[log_df['page'] == 'NextSong']
+    df = df.merge(song_df[['title', 'artist_name', 'song_id', 'artist_id']],
+                  left_on=['song', 'artist'], right_on=['title', 'artist_name'])
+    dt = pd.to_datetime(df['ts'].astype('int64'), unit='ms')
+
+    songplays_table = pd.DataFrame({
+        'songplay_id': songplay_ids(df),
+        'start_time': df['ts'].astype('int64'),
+        'user_id': df['userId'],
+        'level': df['level'],
+        'song_id': df['song_id'],
+        'artist_id': df['artist_id'],
+        'session_id': df['sessionId'].astype('int64'),
+        'location': df['location'],
+        'user_agent': df['userAgent'],
+        'year': dt.dt.year.astype('int32'),
+        'month': dt.dt.month.astype('int32')
+    })
+    write_table(songplays_table, output_data, 'songplays')
+
+
+def process_sessions(log_df, output_data):
+    """
+    Generates the sessions dataset from the log dataset, as etl.session_rows.
+    :param log_df: log dataset
+    :param output_data: path to the output files
+    :return: None
+    """
+    df = log_df[log_df['page'] == 'NextSong'].sort_values(['ts', 'itemInSession'])
+    df = df.assign(paid=(df['level'] == 'paid').astype('int64'))
+    df = df.assign(previous_level=df.groupby(['sessionId', 'userId'])['level'].shift())
+    df = df.assign(change=(df['previous_level'].notna() & (df['previous_level'] != df['level'])).astype('int64'))
+
+    sessions = df.groupby(['sessionId', 'userId'], sort=False).agg(
+        start_time=('ts', 'min'), end_time=('ts', 'max'), songs=('ts', 'size'), paid_songs=('paid', 'sum'),
+        level_changes=('change', 'sum'), first_level=('level', 'first'), last_level=('level', 'last')).reset_index()
+    start = pd.to_datetime(sessions['start_time'].astype('int64'), unit='ms')
+
+    sessions_table = pd.DataFrame({
+        'session_id': sessions['sessionId'].astype('int64'),
+        'user_id': sessions['userId'],
+        'start_time': sessions['start_time'].astype('int64'),
+        'end_time': sessions['end_time'].astype('int64'),
+        'songs': sessions['songs'].astype('int64'),
+        'paid_songs': sessions['paid_songs'].astype('int64'),
+        'level_changes': sessions['level_changes'].astype('int64'),
+        'first_level': sessions['first_level'],
+        'last_level': sessions['last_level'],
+        'year': start.dt.year.astype('int32'),
+        'month': start.dt.month.astype('int32')
+    })
+    write_table(sessions_table, output_data, 'sessions')
+
+
+def process_song_data(song_df, output_data):
+    process_songs(song_df, output_data)
+    process_artists(song_df, output_data)
+
+
+def process_log_data(log_df, song_df, output_data):
+    process_users(log_df, output_data)
+    process_times(log_df, output_data)
+    process_songplays(log_df, song_df, output_data)
+    process_sessions(log_df, output_data)
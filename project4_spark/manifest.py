@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import fnmatch
+import json
+import logging
+import time
+
+from storage import FileStatus, list_directory_status, path_exists, read_text, write_text
+
+# manifests of the input files, one JSON file per input dataset (relative to output_data)
+MANIFEST_PATH_SUFFIX = '_manifest/'
+# number of directories listed at the same time
+LIST_THREADS = 16
+# object stores have no directory modification times: a prefix of the previous manifest is reused without listing
+# it until it was listed this many seconds ago (None: only with --refresh-manifest)
+OBJECT_STORE_TTL_S = 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def manifest_path(output_data, name):
+    return output_data + MANIFEST_PATH_SUFFIX + name + '.json'
+
+
+def read_manifest(spark, output_data, name, pattern):
+    """
+    Reads the manifest saved by a previous run.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :param name: name of the input dataset
+    :param pattern: glob pattern the manifest must have been built for
+    :return: dict prefix -> {'modified': modification time of the directory, 'listed_at': time of the listing,
+             'files': [[name, size, modified]]} or None if there is no manifest of this pattern
+    """
+    text = read_text(spark, manifest_path(output_data, name))
+    if not text:
+        return None
+    manifest = json.loads(text)
+    return manifest['prefixes'] if manifest['pattern'] == pattern else None
+
+
+def leaf_prefixes(spark, input_data, directory_segments, pool):
+    """
+    Finds the directories matching the directory levels of a glob pattern, listing each level in parallel.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param directory_segments: glob segments of the directories, such as ['song_data', '*', '*', '*']
+    :param pool: thread pool the listings run in
+    :return: list of FileStatus of the matching directories
+    """
+    leaves = [FileStatus(input_data.rstrip('/'), 0, 0)]
+    for segment in directory_segments:
+        children = pool.map(lambda d: list_directory_status(spark, d.path)[1], leaves)
+        leaves = [d for directories in children for d in directories
+                  if fnmatch.fnmatchcase(d.path.rsplit('/', 1)[1], segment)]
+    return leaves
+
+
+def is_fresh(entry, directory, now):
+    """
+    Checks whether the entry of a leaf prefix in the previous manifest can be reused without listing the prefix.
+    :param entry: entry of the prefix in the previous manifest
+    :param directory: FileStatus of the prefix directory
+    :param now: current time in seconds
+    :return: True if the entry can be reused
+    """
+    if directory.modified > 0:
+        return entry['modified'] == directory.modified
+    if OBJECT_STORE_TTL_S is None:
+        return True
+    return now - entry.get('listed_at', 0) < OBJECT_STORE_TTL_S
+
+
+def build_manifest(spark, input_data, pattern, previous=None):
+    """
+    Lists the input files matching a glob pattern. The directory levels are listed in parallel to find the leaf
+    prefixes, then the files of the new leaf prefixes and of the prefixes that changed (see is_fresh). Adding,
+    removing or renaming a file changes the modification time of its directory on local file systems and HDFS.
+    Rewriting or appending to a file does not, so the sizes and modification times of a reused prefix can be stale.
+    Object stores have no directory modification times: their prefixes are reused until OBJECT_STORE_TTL_S, so
+    files added to an existing prefix are missed until then (use refresh in manifest_files).
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param pattern: glob pattern relative to input_data, such as etl.SONG_FILES_PATH_SUFFIX
+    :param previous: prefixes of the previous manifest (see read_manifest) or None to list everything
+    :return: tuple (dict prefix -> entry as in read_manifest, number of prefixes listed)
+    """
+    segments = pattern.split('/')
+    previous = previous or {}
+    prefixes = {}
+    now = time.time()
+
+    def list_prefix(directory):
+        files, _ = list_directory_status(spark, directory.path)
+        return directory, [[f.path.rsplit('/', 1)[1], f.size, f.modified] for f in files
+                           if fnmatch.fnmatchcase(f.path.rsplit('/', 1)[1], segments[-1])]
+
+    with ThreadPoolExecutor(LIST_THREADS) as pool:
+        stale = []
+        for directory in leaf_prefixes(spark, input_data, segments[:-1], pool):
+            entry = previous.get(directory.path)
+            if entry is not None and is_fresh(entry, directory, now):
+                prefixes[directory.path] = entry
+            else:
+                stale.append(directory)
+
+        for directory, files in pool.map(list_prefix, stale):
+            prefixes[directory.path] = {'modified': directory.modified, 'listed_at': now, 'files': files}
+    return prefixes, len(stale)
+
+
+def manifest_files(spark, input_data, output_data, name, pattern, refresh=False):
+    """
+    Lists the input files of a dataset from its manifest, refreshing the prefixes that changed since
+    the previous run (see build_manifest). The manifest is saved again when it changed.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param output_data: path to the output files (the manifest is saved there)
+    :param name: name of the input dataset, such as 'song_data'
+    :param pattern: glob pattern relative to input_data
+    :param refresh: ignore the saved manifest and list every prefix again
+    :return: list of FileStatus sorted by path
+    """
+    if not path_exists(spark, input_data):
+        return []
+
+    start = time.time()
+    previous = None if refresh else read_manifest(spark, output_data, name, pattern)
+    prefixes, listed = build_manifest(spark, input_data, pattern, previous)
+    if prefixes != previous:
+        manifest = {'pattern': pattern, 'prefixes': prefixes, 'updated_at': datetime.utcnow().isoformat()}
+        write_text(spark, manifest_path(output_data, name), json.dumps(manifest, sort_keys=True))
+
+    files = sorted(FileStatus(prefix + '/' + f[0], f[1], f[2])
+                   for prefix, entry in prefixes.items() for f in entry['files'])
+    logger.info('Manifest %s: %d files in %d prefixes (%d prefixes listed) in %.2f s', name, len(files),
+                len(prefixes), listed, time.time() - start)
+    return files
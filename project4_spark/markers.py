@@ -0,0 +1,143 @@
+import ast
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+from storage import delete_path, path_exists, read_text, write_text
+
+# completion markers of the output tables, one JSON file per table (relative to output_data)
+MARKER_PATH_SUFFIX = '_markers/'
+# module whose source code, and the source code of the project modules it imports, is part of the code version
+# of the tables
+CODE_ROOT_MODULE = 'etl'
+
+logger = logging.getLogger(__name__)
+
+
+def file_fingerprint(files):
+    """
+    Summarizes a list of input files: a digest of their paths, sizes and modification times,
+    so adding, removing, replacing or touching any file changes the fingerprint.
+    :param files: list of storage.FileStatus or archive.Member
+    :return: dict with the keys files, bytes, last_modified and digest
+    """
+    digest = hashlib.sha256()
+    for f in sorted(files, key=lambda f: f.path):
+        digest.update('{}\t{}\t{}\n'.format(f.path, f.size, f.modified).encode('utf-8'))
+    return {
+        'files': len(files),
+        'bytes': sum(f.size for f in files),
+        'last_modified': max(f.modified for f in files) if files else None,
+        'digest': digest.hexdigest()
+    }
+
+
+def project_modules(root=CODE_ROOT_MODULE):
+    """
+    Finds the modules of this project imported by a module, directly or through other project modules
+    (imports inside functions included).
+    :param root: name of the module
+    :return: sorted list of module names, root included
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    modules, pending = set(), [root]
+    while pending:
+        name = pending.pop()
+        path = os.path.join(directory, name + '.py')
+        if name in modules or not os.path.isfile(path):
+            continue
+        modules.add(name)
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending += [alias.name.split('.')[0] for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split('.')[0])
+    return sorted(modules)
+
+
+def code_version(definition):
+    """
+    Computes the code version of a table: a digest of the source of the project modules used by the ETL
+    (see project_modules) and of the table definition, so any change to the ETL code, such as the way the input
+    files are listed or read, or to the layout of the table (e.g. --sort-by) changes it.
+    :param definition: string describing the table, such as the repr of its etl.OutputTable
+    :return: hex digest
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256(definition.encode('utf-8'))
+    for name in project_modules():
+        with open(os.path.join(directory, name + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def marker_path(output_data, name):
+    return output_data + MARKER_PATH_SUFFIX + name + '.json'
+
+
+def stage_marker(definition, inputs):
+    """
+    Builds the expected completion marker of a table.
+    :param definition: string describing the table (see code_version)
+    :param inputs: dict input name -> list of files the table is built from
+    :return: dict with the keys code_version and inputs
+    """
+    return {
+        'code_version': code_version(definition),
+        'inputs': dict((source, file_fingerprint(files)) for source, files in inputs.items())
+    }
+
+
+def is_complete(spark, output_data, name, table_path, marker):
+    """
+    Checks if a table was already built from the same inputs with the same code.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :param name: name of the table
+    :param table_path: path to the dataset of the table
+    :param marker: expected marker, see stage_marker
+    :return: True if the saved marker matches and the dataset exists
+    """
+    text = read_text(spark, marker_path(output_data, name))
+    if not text:
+        return False
+
+    saved = json.loads(text)
+    if saved['code_version'] != marker['code_version']:
+        logger.info('Table %s: code changed since the last build', name)
+        return False
+    if saved['inputs'] != marker['inputs']:
+        logger.info('Table %s: inputs changed since the last build', name)
+        return False
+    return path_exists(spark, table_path)
+
+
+def tracked(spark, output_data, name, func, marker):
+    """
+    Wraps the build of a table so its marker is removed when the build starts and saved when it succeeds.
+    A build that fails (or is interrupted) leaves the table without a marker, so it is rebuilt by the next resume.
+    :param spark: spark session
+    :param output_data: path to the output files
+    :param name: name of the table
+    :param func: process_* function of the table
+    :param marker: marker saved when the build succeeds, see stage_marker. None only removes the marker
+                   (the table is changed by a run whose inputs cannot be fingerprinted, such as a merge).
+    :return: function with the arguments of func
+    """
+    path = marker_path(output_data, name)
+
+    def build(*args):
+        delete_path(spark, path)
+        start = time.time()
+        func(*args)
+        if marker is not None:
+            completed = dict(marker, table=name, seconds=round(time.time() - start, 3),
+                             completed_at=datetime.utcnow().isoformat())
+            write_text(spark, path, json.dumps(completed, sort_keys=True))
+
+    return build
@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+import functools
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+# metrics of the Spark REST API summed over all the stages of a job group
+STAGE_METRICS = ['executorRunTime', 'executorCpuTime', 'inputBytes', 'inputRecords', 'outputBytes', 'outputRecords',
+                 'shuffleReadBytes', 'shuffleReadRecords', 'shuffleWriteBytes', 'shuffleWriteRecords',
+                 'memoryBytesSpilled', 'diskBytesSpilled']
+
+logger = logging.getLogger(__name__)
+
+# recorder used by the functions decorated with instrument (see MetricsRecorder.activate)
+_active_recorder = None
+
+
+def wait_for_listeners(spark, timeout_ms=10000):
+    """
+    Waits until the Spark listeners processed all the pending events, so the metrics of the jobs
+    that just finished are available.
+    :param spark: spark session
+    :param timeout_ms: maximum time to wait
+    :return: None
+    """
+    spark.sparkContext._jsc.sc().listenerBus().waitUntilEmpty(timeout_ms)
+
+
+def rest_api(spark, endpoint):
+    """
+    Calls the monitoring REST API of the Spark UI of the current application.
+    :param spark: spark session
+    :param endpoint: endpoint relative to the application (e.g. 'stages/3')
+    :return: decoded JSON response
+    """
+    url = '{}/api/v1/applications/{}/{}'.format(spark.sparkContext.uiWebUrl, spark.sparkContext.applicationId,
+                                                endpoint)
+    with urlopen(url) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def job_group_metrics(spark, job_group):
+    """
+    Sums the task metrics of all the stages run by the jobs of a job group.
+    :param spark: spark session
+    :param job_group: job group set with SparkContext.setJobGroup
+    :return: dict metric -> value (empty if the Spark UI is disabled)
+    """
+    if not spark.sparkContext.uiWebUrl:
+        return {}
+
+    wait_for_listeners(spark)
+    tracker = spark.sparkContext.statusTracker()
+
+    stage_ids = set()
+    for job_id in tracker.getJobIdsForGroup(job_group):
+        info = tracker.getJobInfo(job_id)
+        if info:
+            stage_ids.update(info.stageIds)
+
+    totals = dict((m, 0) for m in STAGE_METRICS)
+    for stage_id in stage_ids:
+        # one entry per stage attempt; skipped stages are reported without metrics
+        for attempt in rest_api(spark, 'stages/{}'.format(stage_id)):
+            for m in STAGE_METRICS:
+                totals[m] += attempt.get(m, 0)
+
+    return totals
+
+
+class MetricsRecorder(object):
+    """
+    Records the Spark task metrics of each instrumented function of a run.
+    Every call runs in its own Spark job group, named after the function, so its jobs can be told apart
+    from the jobs of the other functions.
+    """
+
+    def __init__(self, spark):
+        self.spark = spark
+        self.records = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def activate(self):
+        """
+        Makes this recorder the one used by the functions decorated with instrument.
+        :return: self
+        """
+        global _active_recorder
+        _active_recorder = self
+        return self
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that tags the Spark jobs run inside it and records their metrics.
+        :param name: name of the stage (usually the name of the process_* function)
+        """
+        job_group = '{}-{}'.format(name, next(self._ids))
+        sc = self.spark.sparkContext
+        sc.setJobGroup(job_group, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            wall_time = time.time() - start
+            record = {'stage': name, 'application_id': sc.applicationId, 'timestamp': time.time(),
+                      'wall_time_s': round(wall_time, 3)}
+            try:
+                record.update(job_group_metrics(self.spark, job_group))
+            except Exception:
+                logger.exception('Could not collect the metrics of %s', name)
+            sc.setLocalProperty('spark.jobGroup.id', None)
+            sc.setLocalProperty('spark.job.description', None)
+
+            with self._lock:
+                self.records.append(record)
+            logger.info('Metrics of %s: %s', name, json.dumps(record))
+
+    def write(self, path, fmt='jsonl'):
+        """
+        Writes the recorded metrics to a local file.
+        :param path: path to the file
+        :param fmt: 'jsonl' (one JSON line per stage, appended) or 'prometheus' (node exporter textfile, replaced)
+        :return: None
+        """
+        if fmt == 'prometheus':
+            # the textfile collector may read the file at any time, so it is replaced atomically
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        else:
+            with open(path, 'a') as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + '\n')
+
+    def prometheus_text(self):
+        """
+        Formats the recorded metrics in the Prometheus text exposition format.
+        :return: string
+        """
+        lines = []
+        names = ['wall_time_s'] + STAGE_METRICS
+        for name in names:
+            metric = 'sparkify_etl_' + re.sub('([a-z])([A-Z])', r'\1_\2', name).lower()
+            lines.append('# TYPE {} gauge'.format(metric))
+            for record in self.records:
+                if name in record:
+                    lines.append('{}{{stage="{}"}} {}'.format(metric, record['stage'], record[name]))
+        return '\n'.join(lines) + '\n'
+
+
+def instrument(func):
+    """
+    Decorator that records the metrics of a function when a MetricsRecorder is active.
+    :param func: function to be instrumented
+    :return: decorated function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active_recorder is None:
+            return func(*args, **kwargs)
+        with _active_recorder.stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
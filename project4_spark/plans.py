@@ -0,0 +1,295 @@
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+# physical operators reported as the join strategy of a plan
+JOIN_OPERATORS = ['BroadcastHashJoin', 'SortMergeJoin', 'ShuffledHashJoin', 'BroadcastNestedLoopJoin',
+                  'CartesianProduct']
+# filters reported for each file scan
+SCAN_FILTERS = ['PartitionFilters', 'PushedFilters', 'DataFilters']
+# scan of a persisted dataframe (such as the sources shared by the table builds) and the name of its predicates
+CACHED_SCAN = 'InMemoryTableScan'
+CACHED_SCAN_FILTER = 'Predicates'
+# summary of the plans of a run saved in each table file, the formatted plans are saved next to it
+SUMMARY_SUFFIX = '.json'
+FORMATTED_SUFFIX = '.txt'
+RUN_FILE = 'run.json'
+
+logger = logging.getLogger(__name__)
+
+# recorder used by capture_plan (see PlanRecorder.activate) and table being built by the current thread
+_active_recorder = None
+_building = threading.local()
+
+
+def normalize(text):
+    """
+    Removes the expression and plan ids of a plan line, which change from run to run.
+    :param text: line of a plan
+    :return: string
+    """
+    text = re.sub(r'#\d+L?', '', text)
+    text = re.sub(r',? ?\[plan_id=\d+\]', '', text)
+    return text.strip()
+
+
+def plan_operators(tree):
+    """
+    Parses the tree string of a physical plan.
+    :param tree: string returned by executedPlan().toString()
+    :return: list of tuples (operator name, normalized arguments), in the order of the tree
+    """
+    operators = []
+    for line in tree.splitlines():
+        match = re.match(r'^[\s:+\-|]*(?:\*\(\d+\)\s+)?([A-Za-z]+)(.*)$', line)
+        if match and not line.strip().startswith('=='):
+            operators.append((match.group(1), normalize(match.group(2))))
+    return operators
+
+
+def scan_filters(arguments):
+    """
+    Extracts the filters of a file scan.
+    :param arguments: normalized arguments of a FileScan operator
+    :return: dict filter name (see SCAN_FILTERS) -> filters as written in the plan
+    """
+    filters = {}
+    for name in SCAN_FILTERS:
+        match = re.search(name + r': \[(.*?)\](?:, \w+:|$)', arguments)
+        if match:
+            filters[name] = match.group(1)
+    return filters
+
+
+def cached_scan_predicates(arguments):
+    """
+    Extracts the predicates of a scan of a persisted dataframe.
+    :param arguments: normalized arguments of an InMemoryTableScan operator, such as '[a, b], [isnotnull(a)]'
+    :return: dict with the predicates as written in the plan (empty if the scan has none)
+    """
+    match = re.match(r'^\[[^\]]*\], \[(.*)\]$', arguments)
+    return {CACHED_SCAN_FILTER: match.group(1)} if match else {}
+
+
+def summarize_plan(tree):
+    """
+    Extracts the key choices of a physical plan: joins, exchanges and scans (of files and of persisted dataframes)
+    with their filters.
+    :param tree: string returned by executedPlan().toString()
+    :return: dict with the keys joins, exchanges, scans and operators (number of each operator)
+    """
+    operators = plan_operators(tree)
+    return {
+        'joins': ['{} {}'.format(name, arguments) for name, arguments in operators if name in JOIN_OPERATORS],
+        'exchanges': ['{} {}'.format(name, arguments) for name, arguments in operators if name.endswith('Exchange')],
+        'scans': [dict(scan='FileScan ' + arguments.split(' ', 1)[0], **scan_filters(arguments))
+                  for name, arguments in operators if name == 'FileScan'] +
+                 [dict(scan=CACHED_SCAN, **cached_scan_predicates(arguments))
+                  for name, arguments in operators if name == CACHED_SCAN],
+        'operators': dict(Counter(name for name, _ in operators))
+    }
+
+
+class PlanRecorder(object):
+    """
+    Records the physical plan of every dataset written by the table builds of a run and saves them
+    in a versioned directory: a formatted plan and a summary (see summarize_plan) per table.
+    The plans are captured before execution, so with adaptive query execution they are the initial plans.
+    """
+
+    def __init__(self, plans_dir, version=None):
+        self.version = version or datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        self.directory = os.path.join(plans_dir, self.version)
+        self.plans = {}
+        self._lock = threading.Lock()
+
+    def activate(self):
+        """
+        Makes this recorder the one used by capture_plan.
+        :return: self
+        """
+        global _active_recorder
+        _active_recorder = self
+        return self
+
+    def deactivate(self):
+        global _active_recorder
+        if _active_recorder is self:
+            _active_recorder = None
+
+    def record(self, table, df, label):
+        """
+        Records the plan of a dataframe written by a table build.
+        :param table: name of the table
+        :param df: dataframe about to be written
+        :param label: name of the written dataset
+        :return: None
+        """
+        query_execution = df._jdf.queryExecution()
+        tree = query_execution.executedPlan().toString()
+        formatted = df._sc._jvm.PythonSQLUtils.explainString(query_execution, 'formatted')
+        with self._lock:
+            self.plans.setdefault(table, []).append(
+                {'label': label, 'summary': summarize_plan(tree), 'formatted': formatted})
+
+    def write(self, metadata=None):
+        """
+        Saves the recorded plans.
+        :param metadata: dict saved in RUN_FILE with the version and the creation time (e.g. the options of the run)
+        :return: path to the version directory
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for table, records in self.plans.items():
+            with open(os.path.join(self.directory, table + SUMMARY_SUFFIX), 'w') as f:
+                json.dump([dict(r['summary'], label=r['label']) for r in records], f, indent=2, sort_keys=True)
+            with open(os.path.join(self.directory, table + FORMATTED_SUFFIX), 'w') as f:
+                for r in records:
+                    f.write('== {} ==\n{}\n'.format(r['label'], r['formatted']))
+
+        run = dict(metadata or {}, version=self.version, created_at=datetime.utcnow().isoformat(),
+                   tables=sorted(self.plans))
+        with open(os.path.join(self.directory, RUN_FILE), 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+        logger.info('Plans of %d tables saved in %s', len(self.plans), self.directory)
+        return self.directory
+
+
+@contextmanager
+def building(table):
+    """
+    Context manager that assigns the plans captured by the current thread to a table.
+    :param table: name of the table being built
+    """
+    previous = getattr(_building, 'table', None)
+    _building.table = table
+    try:
+        yield
+    finally:
+        _building.table = previous
+
+
+def capture_plan(df, label):
+    """
+    Records the plan of a dataframe about to be written when a PlanRecorder is active and a table is being built.
+    A failure to capture the plan is logged and does not stop the write.
+    :param df: dataframe about to be written
+    :param label: name of the written dataset
+    :return: None
+    """
+    table = getattr(_building, 'table', None)
+    if _active_recorder is None or table is None:
+        return
+    try:
+        _active_recorder.record(table, df, label)
+    except Exception:
+        logger.exception('Could not capture the plan of %s', label)
+
+
+def read_summaries(directory):
+    """
+    Reads the plan summaries of a run.
+    :param directory: version directory written by PlanRecorder.write
+    :return: dict table -> list of summaries, one per written dataset
+    """
+    summaries = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(SUMMARY_SUFFIX) and name != RUN_FILE:
+            with open(os.path.join(directory, name)) as f:
+                summaries[name[:-len(SUMMARY_SUFFIX)]] = json.load(f)
+    return summaries
+
+
+def diff_summary(old, new):
+    """
+    Compares the plans of a written dataset in two runs.
+    :param old: summary of the old run
+    :param new: summary of the new run
+    :return: list of changes, as strings
+    """
+    changes = []
+    old_joins, new_joins = [j.split(' ', 1)[0] for j in old['joins']], [j.split(' ', 1)[0] for j in new['joins']]
+    if old_joins != new_joins:
+        changes.append('join strategy: {} -> {}'.format(', '.join(old_joins) or 'none', ', '.join(new_joins) or 'none'))
+    else:
+        changes += ['join changed: {} -> {}'.format(o, n) for o, n in zip(old['joins'], new['joins']) if o != n]
+
+    old_exchanges, new_exchanges = Counter(old['exchanges']), Counter(new['exchanges'])
+    changes += ['added exchange: ' + e for e in sorted((new_exchanges - old_exchanges).elements())]
+    changes += ['removed exchange: ' + e for e in sorted((old_exchanges - new_exchanges).elements())]
+
+    if [s['scan'] for s in old['scans']] != [s['scan'] for s in new['scans']]:
+        changes.append('scans: {} -> {}'.format([s['scan'] for s in old['scans']], [s['scan'] for s in new['scans']]))
+    else:
+        for o, n in zip(old['scans'], new['scans']):
+            for name in SCAN_FILTERS + [CACHED_SCAN_FILTER]:
+                if o.get(name) != n.get(name):
+                    changes.append('{} {}: [{}] -> [{}]'.format(o['scan'], name, o.get(name, ''), n.get(name, '')))
+
+    counts = sorted(set(old['operators']) | set(new['operators']))
+    changed = ['{} {} -> {}'.format(c, old['operators'].get(c, 0), new['operators'].get(c, 0)) for c in counts
+               if old['operators'].get(c, 0) != new['operators'].get(c, 0)]
+    if changed:
+        changes.append('operators: ' + ', '.join(changed))
+    return changes
+
+
+def diff_runs(old_directory, new_directory):
+    """
+    Compares the plans of two runs saved by PlanRecorder.
+    :param old_directory: version directory of the old run
+    :param new_directory: version directory of the new run
+    :return: list of tuples (table, label of the written dataset, change)
+    """
+    old, new = read_summaries(old_directory), read_summaries(new_directory)
+    changes = []
+    for table in sorted(set(old) | set(new)):
+        if table not in new:
+            changes.append((table, '', 'table missing from the new run'))
+            continue
+        if table not in old:
+            changes.append((table, '', 'table missing from the old run'))
+            continue
+        if [s['label'] for s in old[table]] != [s['label'] for s in new[table]]:
+            changes.append((table, '', 'written datasets: {} -> {}'.format(
+                [s['label'] for s in old[table]], [s['label'] for s in new[table]])))
+        for o, n in zip(old[table], new[table]):
+            changes += [(table, n['label'], change) for change in diff_summary(o, n)]
+    return changes
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Compare the physical plans of two runs of the Sparkify ETL')
+    parser.add_argument('old', help='version directory of the old run (e.g. plans/baseline)')
+    parser.add_argument('new', help='version directory of the new run')
+    parser.add_argument('--fail-on-change', action='store_true',
+                        help='exit with status 1 if the plans changed')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    args = parse_args()
+
+    changes = diff_runs(args.old, args.new)
+    for table, label, change in changes:
+        print('{}{}: {}'.format(table, ' ({})'.format(label) if label else '', change))
+    print('{} plan changes between {} and {}'.format(len(changes), args.old, args.new))
+
+    if changes and args.fail_on_change:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
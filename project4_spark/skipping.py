@@ -0,0 +1,322 @@
+from collections import namedtuple
+import base64
+import hashlib
+import json
+import logging
+import math
+from pyspark.sql.functions import col, count, countDistinct, input_file_name, lit, min as min_, max as max_
+from pyspark.sql.utils import AnalysisException
+
+from storage import path_exists, list_directory, read_text, write_text
+from writer import partition_directories, partition_subpath
+
+# columns of a dataset indexed per file: a bloom filter of the values of bloom_columns
+# and the min/max of range_columns
+SkippingIndex = namedtuple('SkippingIndex', ['bloom_columns', 'range_columns'])
+
+# index saved in each partition directory of the indexed datasets
+INDEX_NAME = '_index.json'
+# false positive rate of the bloom filters
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of string values. The positions of a value are derived from the MD5 of its string form
+    (double hashing), so the filters written by Spark jobs can be checked from any python process.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def sized(cls, num_values, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        """
+        Builds an empty filter sized for a number of distinct values.
+        :param num_values: number of distinct values
+        :param false_positive_rate: expected rate of values reported as present while they are not
+        :return: BloomFilter
+        """
+        n = max(1, num_values)
+        num_bits = max(8, int(math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / float(n) * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def of(cls, values, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        """
+        Builds a filter sized for a set of values.
+        :param values: distinct values
+        :param false_positive_rate: expected rate of values reported as present while they are not
+        :return: BloomFilter
+        """
+        bloom = cls.sized(len(values), false_positive_rate)
+        for v in values:
+            bloom.add(v)
+        return bloom
+
+    def positions(self, value):
+        digest = hashlib.md5(str(value).encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        for p in self.positions(value):
+            self.bits[p // 8] |= 1 << (p % 8)
+
+    def might_contain(self, value):
+        return all(self.bits[p // 8] & (1 << (p % 8)) for p in self.positions(value))
+
+    def to_dict(self):
+        return {'bits': self.num_bits, 'hashes': self.num_hashes,
+                'data': base64.b64encode(bytes(self.bits)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['bits'], d['hashes'], bytearray(base64.b64decode(d['data'])))
+
+
+def bloom_bits(df, bloom_columns, sizes):
+    """
+    Builds the bloom filters of the data files of a dataset on the executors: each task fills the filters
+    of the files it reads and the filters of the same file are merged with a bitwise or, so only the bits
+    of the filters reach the driver. The hashing of BloomFilter.positions is repeated in the tasks,
+    so the executors do not need to import this module.
+    :param df: dataframe with the column _file (input_file_name) and the bloom_columns
+    :param bloom_columns: list of columns
+    :param sizes: dict (file, column) -> (number of bits, number of hashes) of the filter
+    :return: dict (file, column) -> bytearray with the bits of the filter
+    """
+    sizes_broadcast = df.rdd.context.broadcast(sizes)
+
+    def fill_filters(rows):
+        import hashlib
+        sizes = sizes_broadcast.value
+        filters = {}
+        for row in rows:
+            for c in bloom_columns:
+                value = row[c]
+                if value is None:
+                    continue
+                key = (row['_file'], c)
+                num_bits, num_hashes = sizes[key]
+                if key not in filters:
+                    filters[key] = bytearray((num_bits + 7) // 8)
+                digest = hashlib.md5(str(value).encode('utf-8')).digest()
+                h1 = int.from_bytes(digest[:8], 'little')
+                h2 = int.from_bytes(digest[8:], 'little') | 1
+                for i in range(num_hashes):
+                    p = (h1 + i * h2) % num_bits
+                    filters[key][p // 8] |= 1 << (p % 8)
+        return iter(filters.items())
+
+    def merge_bits(a, b):
+        return bytearray(x | y for x, y in zip(a, b))
+
+    try:
+        return df.select('_file', *bloom_columns).rdd.mapPartitions(fill_filters).reduceByKey(merge_bits).collectAsMap()
+    finally:
+        sizes_broadcast.unpersist()
+
+
+def build_index(spark, path, partition_by, index, directories=None):
+    """
+    Writes the data-skipping index of a Parquet dataset: an INDEX_NAME file in each partition directory
+    with, for every data file, the bloom filters of index.bloom_columns and the min/max of index.range_columns.
+    A first Spark job computes the rows, the distinct values (which size the bloom filters) and the min/max
+    of every file, a second one builds the bloom filters on the executors (see bloom_bits).
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param partition_by: list of partition columns
+    :param index: SkippingIndex or None (nothing is done)
+    :param directories: partition directories to be indexed (all of them when None)
+    :return: None
+    """
+    if index is None or (directories is not None and not directories) or not path_exists(spark, path):
+        return
+
+    path = path.rstrip('/')
+    reader = spark.read.option('basePath', path)
+    try:
+        df = reader.parquet(*directories) if directories else reader.parquet(path)
+    except AnalysisException:
+        # the dataset has no data files
+        return
+    df = df.withColumn('_file', input_file_name())
+
+    aggregations = [count(lit(1)).alias('rows')]
+    aggregations += [countDistinct(c).alias('distinct_' + c) for c in index.bloom_columns]
+    for c in index.range_columns:
+        aggregations += [min_(c).alias('min_' + c), max_(c).alias('max_' + c)]
+    rows = df.groupBy('_file', *partition_by).agg(*aggregations).collect()
+
+    filters = {}
+    for row in rows:
+        for c in index.bloom_columns:
+            filters[(row['_file'], c)] = BloomFilter.sized(row['distinct_' + c])
+    bits = bloom_bits(df, index.bloom_columns, dict((k, (f.num_bits, f.num_hashes)) for k, f in filters.items()))
+    for key, data in bits.items():
+        filters[key].bits = data
+
+    # directories left without files get an empty index
+    entries = dict((d.rstrip('/'), []) for d in directories or [])
+    for row in rows:
+        directory = path + '/' + partition_subpath(row, partition_by) if partition_by else path
+        entries.setdefault(directory, []).append({
+            'file': row['_file'].rsplit('/', 1)[1],
+            'rows': row['rows'],
+            'bloom': dict((c, filters[(row['_file'], c)].to_dict()) for c in index.bloom_columns),
+            'min_max': dict((c, [row['min_' + c], row['max_' + c]]) for c in index.range_columns)
+        })
+
+    for directory, files in entries.items():
+        write_text(spark, directory + '/' + INDEX_NAME, json.dumps(files))
+    logger.info('Indexed %d files in %d partitions of %s', len(rows), len(entries), path)
+
+
+def might_match(entry, equal=None, between=None):
+    """
+    Checks if a data file may hold rows matching the filters, according to its index entry.
+    :param entry: index entry of the file
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: False if the file can be skipped
+    """
+    for c, value in (equal or {}).items():
+        bloom = entry['bloom'].get(c)
+        if bloom is not None and not BloomFilter.from_dict(bloom).might_contain(value):
+            return False
+    for c, (low, high) in (between or {}).items():
+        bounds = entry['min_max'].get(c)
+        if bounds is not None and bounds[0] is not None and (bounds[1] < low or bounds[0] > high):
+            return False
+    return True
+
+
+def select_files(files, index_text, equal=None, between=None):
+    """
+    Selects the data files of a partition directory that may hold rows matching the filters.
+    Files missing from the index (such as files written after it) are always selected.
+    :param files: names of the data files of the directory
+    :param index_text: content of the INDEX_NAME file of the directory or None
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: list of names
+    """
+    entries = dict((e['file'], e) for e in json.loads(index_text)) if index_text else {}
+    return [f for f in files if f not in entries or might_match(entries[f], equal, between)]
+
+
+def filter_condition(equal=None, between=None):
+    """
+    Builds the Spark condition of the filters.
+    :param equal: dict column -> value
+    :param between: dict column -> (low, high)
+    :return: Column
+    """
+    condition = lit(True)
+    for c, value in (equal or {}).items():
+        condition = condition & (col(c) == value)
+    for c, (low, high) in (between or {}).items():
+        condition = condition & col(c).between(low, high)
+    return condition
+
+
+def prune_files(spark, path, equal=None, between=None):
+    """
+    Lists the data files of a Parquet dataset that may hold rows matching the filters.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: tuple (list of paths to the selected files, number of files of the dataset)
+    """
+    selected, total = [], 0
+    for directory in partition_directories(spark, path):
+        files = [f.path.rsplit('/', 1)[1] for f in list_directory(spark, directory)[0] if f.path.endswith('.parquet')]
+        total += len(files)
+        index_text = read_text(spark, directory.rstrip('/') + '/' + INDEX_NAME)
+        selected += [directory.rstrip('/') + '/' + f for f in select_files(files, index_text, equal, between)]
+
+    logger.info('Index of %s: %d of %d files pruned', path, total - len(selected), total)
+    return selected, total
+
+
+def read_spark(spark, path, equal=None, between=None):
+    """
+    Reads the rows of a Parquet dataset matching the filters, opening only the files selected by the index.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: dataframe
+    """
+    files, _ = prune_files(spark, path, equal, between)
+    if not files:
+        return spark.read.parquet(path).limit(0)
+    return spark.read.option('basePath', path).parquet(*files).filter(filter_condition(equal, between))
+
+
+def prune_files_arrow(path, equal=None, between=None):
+    """
+    Lists the data files of a Parquet dataset that may hold rows matching the filters, with pyarrow.
+    :param path: path to the Parquet dataset (local, file:// or s3a://)
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: tuple (pyarrow FileSystem, path in the file system, list of selected files, number of files)
+    """
+    import pyarrow.fs as pafs
+    import local_engine
+
+    fs, base = local_engine.resolve(path)
+    base = base.rstrip('/')
+    by_directory = {}
+    for info in fs.get_file_info(pafs.FileSelector(base, recursive=True)):
+        parts = info.path[len(base) + 1:].split('/')
+        if info.type == pafs.FileType.File and info.path.endswith('.parquet') and \
+                not any(p.startswith('_') or p.startswith('.') for p in parts):
+            directory, name = info.path.rsplit('/', 1)
+            by_directory.setdefault(directory, []).append(name)
+
+    selected, total = [], 0
+    for directory, files in sorted(by_directory.items()):
+        total += len(files)
+        index_path = directory + '/' + INDEX_NAME
+        index_text = None
+        if fs.get_file_info(index_path).type == pafs.FileType.File:
+            with fs.open_input_stream(index_path) as stream:
+                index_text = stream.read().decode('utf-8')
+        selected += [directory + '/' + f for f in select_files(sorted(files), index_text, equal, between)]
+
+    logger.info('Index of %s: %d of %d files pruned', path, total - len(selected), total)
+    return fs, base, selected, total
+
+
+def read_arrow(path, equal=None, between=None):
+    """
+    Reads the rows of a Parquet dataset matching the filters with pyarrow, opening only the files
+    selected by the index. The partition columns are read from the hive style directory names.
+    :param path: path to the Parquet dataset (local, file:// or s3a://)
+    :param equal: dict column -> value, for the bloom filter columns
+    :param between: dict column -> (low, high), for the range columns
+    :return: pyarrow Table
+    """
+    import pyarrow.dataset as ds
+
+    fs, base, files, _ = prune_files_arrow(path, equal, between)
+    if not files:
+        return ds.dataset(base, filesystem=fs, format='parquet', partitioning='hive').schema.empty_table()
+    dataset = ds.dataset(files, filesystem=fs, format='parquet', partitioning='hive', partition_base_dir=base)
+
+    condition = None
+    for c, value in (equal or {}).items():
+        condition = (ds.field(c) == value) if condition is None else condition & (ds.field(c) == value)
+    for c, (low, high) in (between or {}).items():
+        expression = (ds.field(c) >= low) & (ds.field(c) <= high)
+        condition = expression if condition is None else condition & expression
+    return dataset.to_table(filter=condition)
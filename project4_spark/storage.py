@@ -0,0 +1,159 @@
+from collections import namedtuple
+
+# a file of an input or output dataset
+# path: fully qualified path, size: number of bytes, modified: modification time in epoch milliseconds
+FileStatus = namedtuple('FileStatus', ['path', 'size', 'modified'])
+
+
+def hadoop_path(spark, path):
+    """
+    Resolves a path with the hadoop FileSystem API, so S3 and local paths are handled the same way.
+    :param spark: spark session
+    :param path: path to a file or directory
+    :return: tuple (hadoop FileSystem, hadoop Path)
+    """
+    p = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return p.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), p
+
+
+def path_exists(spark, path):
+    """
+    Checks if a file or directory exists.
+    :param spark: spark session
+    :param path: path to a file or directory
+    :return: True if the path exists
+    """
+    fs, p = hadoop_path(spark, path)
+    return fs.exists(p)
+
+
+def list_files(spark, pattern):
+    """
+    Lists the files matching a glob pattern.
+    :param spark: spark session
+    :param pattern: path or glob pattern
+    :return: list of FileStatus sorted by path
+    """
+    fs, p = hadoop_path(spark, pattern)
+    statuses = fs.globStatus(p) or []
+    files = [FileStatus(s.getPath().toString(), s.getLen(), s.getModificationTime())
+             for s in statuses if s.isFile()]
+    return sorted(files)
+
+
+def read_text(spark, path):
+    """
+    Reads a small text file.
+    :param spark: spark session
+    :param path: path to the file
+    :return: content of the file or None if the file does not exist
+    """
+    fs, p = hadoop_path(spark, path)
+    if not fs.exists(p):
+        return None
+
+    stream = fs.open(p)
+    try:
+        return spark.sparkContext._jvm.org.apache.commons.io.IOUtils.toString(stream, 'UTF-8')
+    finally:
+        stream.close()
+
+
+def write_text(spark, path, text):
+    """
+    Writes a small text file, replacing it if it already exists.
+    :param spark: spark session
+    :param path: path to the file
+    :param text: content of the file
+    :return: None
+    """
+    fs, p = hadoop_path(spark, path)
+    stream = fs.create(p, True)
+    try:
+        stream.write(bytearray(text.encode('utf-8')))
+    finally:
+        stream.close()
+
+
+def delete_path(spark, path):
+    """
+    Deletes a file or a directory recursively. Nothing happens if the path does not exist.
+    :param spark: spark session
+    :param path: path to a file or directory
+    :return: None
+    """
+    fs, p = hadoop_path(spark, path)
+    fs.delete(p, True)
+
+
+def list_directory_status(spark, path):
+    """
+    Lists the content of a directory, skipping hidden entries (names starting with _ or .)
+    such as _SUCCESS markers and staging directories.
+    :param spark: spark session
+    :param path: path to the directory
+    :return: tuple (list of FileStatus of the files, list of FileStatus of the subdirectories).
+             The modification time of directories is 0 on object stores such as S3.
+    """
+    fs, p = hadoop_path(spark, path)
+    files, directories = [], []
+    for s in fs.listStatus(p):
+        name = s.getPath().getName()
+        if name.startswith('_') or name.startswith('.'):
+            continue
+        status = FileStatus(s.getPath().toString(), s.getLen(), s.getModificationTime())
+        if s.isDirectory():
+            directories.append(status)
+        else:
+            files.append(status)
+    return sorted(files), sorted(directories)
+
+
+def list_directory(spark, path):
+    """
+    Lists the content of a directory, skipping hidden entries (names starting with _ or .)
+    such as _SUCCESS markers and staging directories.
+    :param spark: spark session
+    :param path: path to the directory
+    :return: tuple (list of FileStatus of the files, list of paths of the subdirectories)
+    """
+    files, directories = list_directory_status(spark, path)
+    return files, [d.path for d in directories]
+
+
+def make_parent_dirs(spark, path):
+    """
+    Creates the parent directories of a path if they do not exist.
+    :param spark: spark session
+    :param path: path to a file or directory
+    :return: None
+    """
+    fs, p = hadoop_path(spark, path)
+    fs.mkdirs(p.getParent())
+
+
+def move_path(spark, source, target):
+    """
+    Moves (renames) a file or directory.
+    :param spark: spark session
+    :param source: current path
+    :param target: new path
+    :return: None
+    """
+    fs, source_path = hadoop_path(spark, source)
+    _, target_path = hadoop_path(spark, target)
+    if not fs.rename(source_path, target_path):
+        raise IOError('Could not move {} to {}'.format(source, target))
+
+
+def path_size(spark, path):
+    """
+    Computes the total size of a file or of all the files under a directory.
+    :param spark: spark session
+    :param path: path to a file or directory
+    :return: number of bytes (0 if the path does not exist)
+    """
+    fs, p = hadoop_path(spark, path)
+    if not fs.exists(p):
+        return 0
+    return fs.getContentSummary(p).getLength()
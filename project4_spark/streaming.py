@@ -0,0 +1,326 @@
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+from pyspark.sql.functions import col, input_file_name, lit
+
+import etl
+from manifest import manifest_files
+from skipping import build_index
+from storage import hadoop_path, path_exists, write_text
+from writer import partition_subpath, record_file_statistics, write_table
+
+# the song dimension is read again when it is older than this
+SONG_REFRESH_SECONDS = 15 * 60
+# interval between two micro-batches and maximum number of new log files read by each one
+TRIGGER_SECONDS = 60
+MAX_FILES_PER_TRIGGER = 100
+# checkpoint of the query and markers of the micro-batches already appended to songplays
+CHECKPOINT_PATH_SUFFIX = '_checkpoint/songplays_stream'
+COMMITTED_DIR = 'committed'
+# malformed log records of the stream are appended here (relative to output_data)
+STREAM_QUARANTINE_NAME = 'log_data_stream'
+
+logger = logging.getLogger(__name__)
+
+
+class SongDimension(object):
+    """
+    Song dataset joined with the log events of each micro-batch.
+    It is read with the declared schema, persisted, and read again when it is older than the refresh interval,
+    so songs added to song_data are picked up without restarting the stream. The song files are listed from
+    the song_data manifest, so a refresh lists only the prefixes that changed.
+    """
+
+    def __init__(self, spark, input_data, output_data, refresh_seconds=SONG_REFRESH_SECONDS):
+        self.spark = spark
+        self.input_data = input_data
+        self.output_data = output_data
+        self.refresh_seconds = refresh_seconds
+        self._df = None
+        self._loaded_at = 0
+
+    def get(self):
+        """
+        Returns the song dataset, reading it again if it is too old.
+        :return: persisted dataframe
+        """
+        if self._df is None or time.time() - self._loaded_at >= self.refresh_seconds:
+            previous = self._df
+            files = manifest_files(self.spark, self.input_data, self.output_data, 'song_data',
+                                   etl.SONG_FILES_PATH_SUFFIX)
+            self._df = etl.read_source(self.spark, 'song_data', files,
+                                       etl.read_schema(etl.SONG_SCHEMA, etl.SONG_COLUMNS), self.output_data)
+            self._loaded_at = time.time()
+            if previous is not None:
+                previous.unpersist()
+            logger.info('Song dimension refreshed')
+        return self._df
+
+    def unpersist(self):
+        if self._df is not None:
+            self._df.unpersist()
+
+
+class StreamMetrics(object):
+    """
+    Collects the metrics of the micro-batches of the songplays stream: the durations reported by the
+    query progress and the end-to-end latency (from the modification time of the log files of the batch
+    to the moment the batch is committed to songplays) measured by SongplaysWriter.
+    """
+
+    # metrics of each micro-batch, in seconds unless named otherwise
+    NAMES = ['batch_duration_s', 'add_batch_s', 'get_batch_s', 'input_rows', 'processed_rows_per_s',
+             'songplays_rows', 'files', 'latency_min_s', 'latency_max_s']
+
+    def __init__(self):
+        self.records = {}
+        self._written = set()
+        self._lock = threading.Lock()
+
+    def update(self, batch_id, values):
+        """
+        Adds metrics to the record of a micro-batch.
+        :param batch_id: id of the micro-batch
+        :param values: dict name -> value
+        :return: None
+        """
+        with self._lock:
+            self.records.setdefault(batch_id, {'batch_id': batch_id}).update(values)
+
+    def add_progress(self, progress):
+        """
+        Adds the durations of the micro-batches reported by StreamingQuery.recentProgress.
+        :param progress: list of progress dicts
+        :return: None
+        """
+        for p in progress:
+            durations = p.get('durationMs', {})
+            self.update(p['batchId'], {
+                'timestamp': p.get('timestamp'),
+                'batch_duration_s': durations.get('triggerExecution', 0) / 1000.0,
+                'add_batch_s': durations.get('addBatch', 0) / 1000.0,
+                'get_batch_s': durations.get('getBatch', 0) / 1000.0,
+                'input_rows': p.get('numInputRows', 0),
+                'processed_rows_per_s': round(p.get('processedRowsPerSecond') or 0, 3)
+            })
+
+    def write(self, path, fmt='jsonl'):
+        """
+        Writes the metrics to a local file.
+        :param path: path to the file
+        :param fmt: 'jsonl' (one JSON line per micro-batch not written yet, appended)
+                    or 'prometheus' (node exporter textfile with the last micro-batch, replaced)
+        :return: None
+        """
+        with self._lock:
+            # the progress of a batch is reported after its commit, so a batch is complete once it has both
+            complete = sorted(b for b, r in self.records.items() if 'batch_duration_s' in r)
+            if fmt == 'prometheus':
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(self.prometheus_text(complete))
+                os.replace(tmp_path, path)
+            else:
+                with open(path, 'a') as f:
+                    for batch_id in complete:
+                        if batch_id not in self._written:
+                            f.write(json.dumps(self.records[batch_id]) + '\n')
+                            self._written.add(batch_id)
+
+    def prometheus_text(self, complete):
+        """
+        Formats the metrics of the last complete micro-batch in the Prometheus text exposition format.
+        :param complete: sorted ids of the complete micro-batches
+        :return: string
+        """
+        lines = ['# TYPE sparkify_stream_batches_total counter',
+                 'sparkify_stream_batches_total {}'.format(len(complete))]
+        if complete:
+            last = self.records[complete[-1]]
+            for name in self.NAMES:
+                if last.get(name) is not None:
+                    lines.append('# TYPE sparkify_stream_{} gauge'.format(name))
+                    lines.append('sparkify_stream_{} {}'.format(name, last[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class SongplaysWriter(object):
+    """
+    foreachBatch function of the songplays stream. It joins the log events of a micro-batch with the song
+    dimension and appends the songplays to the year/month partitions of the batch output.
+    A marker is written in the checkpoint once a batch is appended, so a batch replayed after a restart
+    is not appended twice. If the job dies between the append and the marker, the batch is appended again
+    and the duplicated songplay_id can be removed with an etl.py --upsert run of the same log files.
+    """
+
+    def __init__(self, spark, songs, output_data, checkpoint, metrics):
+        self.spark = spark
+        self.songs = songs
+        self.output_data = output_data
+        self.committed_path = checkpoint.rstrip('/') + '/' + COMMITTED_DIR + '/'
+        self.metrics = metrics
+
+    def __call__(self, batch_df, batch_id):
+        marker = self.committed_path + str(batch_id)
+        if path_exists(self.spark, marker):
+            logger.info('Micro-batch %d already appended, skipped', batch_id)
+            return
+
+        batch_df = batch_df.withColumn('_file', input_file_name()).persist()
+        try:
+            files = [r['_file'] for r in batch_df.select('_file').distinct().collect()]
+            self.quarantine(batch_df.drop('_file'))
+            log_df = batch_df.filter(col(etl.CORRUPT_RECORD_COLUMN).isNull()) \
+                .drop(etl.CORRUPT_RECORD_COLUMN, '_file')
+
+            table = etl.OUTPUT_TABLES['songplays']
+            path = self.output_data + table.path
+            songplays_df = etl.songplays_rows(log_df, self.songs.get()).persist()
+            try:
+                partitions = songplays_df.select(*table.partition_by).distinct().collect()
+                num_rows = songplays_df.count()
+                if num_rows:
+                    write_table(songplays_df, path, table.partition_by, mode='append', sort_by=table.sort_by)
+                    directories = [path.rstrip('/') + '/' + partition_subpath(p, table.partition_by)
+                                   for p in partitions]
+                    record_file_statistics(self.spark, path, table.stats_columns, directories)
+                    build_index(self.spark, path, table.partition_by, table.index, directories)
+            finally:
+                songplays_df.unpersist()
+
+            write_text(self.spark, marker, json.dumps({'files': files, 'songplays': num_rows}))
+            committed = time.time()
+        finally:
+            batch_df.unpersist()
+
+        modified = [self.modification_time(f) for f in files]
+        self.metrics.update(batch_id, {
+            'songplays_rows': num_rows,
+            'files': len(files),
+            'latency_min_s': round(committed - max(modified), 3) if modified else None,
+            'latency_max_s': round(committed - min(modified), 3) if modified else None
+        })
+        logger.info('Micro-batch %d: %d files, %d songplays appended to %d partitions',
+                    batch_id, len(files), num_rows, len(partitions))
+
+    def quarantine(self, batch_df):
+        """
+        Appends the malformed records of a micro-batch to the quarantine dataset, in the partition of the time
+        of the micro-batch, with the same columns as the quarantine of etl.read_source.
+        :param batch_df: micro-batch with the corrupt record column
+        :return: None
+        """
+        corrupt_df = batch_df.filter(col(etl.CORRUPT_RECORD_COLUMN).isNotNull())
+        num_corrupt = corrupt_df.count()
+        if num_corrupt > 0:
+            logger.warning('Stream log_data: %d malformed records moved to quarantine', num_corrupt)
+            corrupt_df.withColumn(etl.QUARANTINE_PARTITION_COLUMN, lit(datetime.utcnow().strftime(etl.RUN_ID_FORMAT))) \
+                .write.mode('append').partitionBy(etl.QUARANTINE_PARTITION_COLUMN) \
+                .parquet(self.output_data + etl.QUARANTINE_PATH_SUFFIX + STREAM_QUARANTINE_NAME)
+
+    def modification_time(self, path):
+        """
+        Reads the modification time of an input file.
+        :param path: path to the file
+        :return: epoch seconds
+        """
+        fs, p = hadoop_path(self.spark, path)
+        return fs.getFileStatus(p).getModificationTime() / 1000.0
+
+
+def start_stream(spark, input_data, output_data, checkpoint, songs, metrics,
+                 trigger_seconds=TRIGGER_SECONDS, max_files_per_trigger=MAX_FILES_PER_TRIGGER, once=False):
+    """
+    Starts the streaming query that builds songplays from the log files arriving in log_data.
+    :param spark: spark session
+    :param input_data: path to the input files
+    :param output_data: path to the output files
+    :param checkpoint: path to the checkpoint of the query
+    :param songs: SongDimension
+    :param metrics: StreamMetrics
+    :param trigger_seconds: interval between two micro-batches
+    :param max_files_per_trigger: maximum number of new log files read by each micro-batch
+    :param once: process the files available now in a single micro-batch and stop
+    :return: StreamingQuery
+    """
+    log_stream = spark.readStream \
+        .schema(etl.read_schema(etl.LOG_SCHEMA, etl.LOG_COLUMNS)) \
+        .option('mode', 'PERMISSIVE') \
+        .option('columnNameOfCorruptRecord', etl.CORRUPT_RECORD_COLUMN) \
+        .option('maxFilesPerTrigger', max_files_per_trigger) \
+        .json(input_data + etl.LOG_FILES_PATH_SUFFIX)
+
+    writer = log_stream.writeStream \
+        .queryName('songplays_stream') \
+        .foreachBatch(SongplaysWriter(spark, songs, output_data, checkpoint, metrics)) \
+        .option('checkpointLocation', checkpoint)
+    if once:
+        writer = writer.trigger(once=True)
+    else:
+        writer = writer.trigger(processingTime='{} seconds'.format(trigger_seconds))
+    return writer.start()
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    :return: argparse namespace
+    """
+    parser = argparse.ArgumentParser(description='Builds songplays continuously from the log files arriving in '
+                                                 'log_data')
+    parser.add_argument('--input', default=etl.S3_PATH, help='path to the input files (local or S3)')
+    parser.add_argument('--output', default=etl.S3_PATH, help='path to the output files (local or S3)')
+    parser.add_argument('--checkpoint', help='path to the checkpoint (default: {} in the output)'
+                        .format(CHECKPOINT_PATH_SUFFIX))
+    parser.add_argument('--profile', choices=sorted(etl.SESSION_PROFILES) + ['auto'], default='auto',
+                        help='spark session profile (see etl.py)')
+    parser.add_argument('--trigger-seconds', type=int, default=TRIGGER_SECONDS,
+                        help='interval between two micro-batches')
+    parser.add_argument('--max-files-per-trigger', type=int, default=MAX_FILES_PER_TRIGGER,
+                        help='maximum number of new log files read by each micro-batch')
+    parser.add_argument('--song-refresh-seconds', type=int, default=SONG_REFRESH_SECONDS,
+                        help='age after which the song dimension is read again')
+    parser.add_argument('--once', action='store_true',
+                        help='process the log files available now and stop')
+    parser.add_argument('--metrics-file', help='local file where the metrics of each micro-batch are written')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prometheus'], default='jsonl',
+                        help='format of the metrics file: JSON lines or Prometheus textfile')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    args = parse_args()
+
+    input_data = args.input if args.input.endswith('/') else args.input + '/'
+    output_data = args.output if args.output.endswith('/') else args.output + '/'
+    checkpoint = args.checkpoint or output_data + CHECKPOINT_PATH_SUFFIX
+
+    profile = etl.choose_profile(input_data) if args.profile == 'auto' else args.profile
+    s3 = not (etl.is_local_path(input_data) and etl.is_local_path(output_data) and etl.is_local_path(checkpoint))
+    spark = etl.create_spark_session(profile=profile, s3=s3)
+
+    songs = SongDimension(spark, input_data, output_data, args.song_refresh_seconds)
+    metrics = StreamMetrics()
+    query = start_stream(spark, input_data, output_data, checkpoint, songs, metrics,
+                         args.trigger_seconds, args.max_files_per_trigger, args.once)
+    try:
+        while query.isActive:
+            query.awaitTermination(args.trigger_seconds)
+            metrics.add_progress(query.recentProgress)
+            if args.metrics_file:
+                metrics.write(args.metrics_file, args.metrics_format)
+    finally:
+        query.stop()
+        metrics.add_progress(query.recentProgress)
+        if args.metrics_file:
+            metrics.write(args.metrics_file, args.metrics_format)
+        songs.unpersist()
+
+
+if __name__ == "__main__":
+    main()
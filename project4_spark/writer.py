@@ -0,0 +1,395 @@
+import json
+import logging
+import math
+from pyspark.sql.functions import col, hash as hash_, lit, pmod
+from pyspark.sql.utils import AnalysisException
+from plans import capture_plan
+from storage import path_exists, list_directory, make_parent_dirs, move_path, delete_path, write_text
+
+# target size of the Parquet files written to the data lake
+TARGET_FILE_BYTES = 128 * 1024 * 1024
+# rough ratio between the in-memory size estimated by Spark and the size of the compressed Parquet files
+PARQUET_COMPRESSION_RATIO = 4
+# partitions whose files are smaller than this on average are rewritten by compact_dataset
+SMALL_FILE_BYTES = TARGET_FILE_BYTES // 4
+# size of the Parquet row groups (the unit skipped by min/max statistics) and compression codec
+ROW_GROUP_BYTES = 32 * 1024 * 1024
+PARQUET_CODEC = 'snappy'
+# per-file statistics saved in each partition directory of the datasets written with stats_columns
+FILE_STATS_NAME = '_file_stats.json'
+
+logger = logging.getLogger(__name__)
+
+
+def estimated_size(df):
+    """
+    Returns the size in bytes estimated by the Catalyst optimizer for a dataframe.
+    :param df: dataframe
+    :return: number of bytes
+    """
+    return int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+
+
+def records_per_file(df, target_file_bytes=TARGET_FILE_BYTES):
+    """
+    Estimates how many records fit in a Parquet file of the target size.
+    The size of a record is the default size Spark assigns to the dataframe schema.
+    :param df: dataframe to be written
+    :param target_file_bytes: target size of the files
+    :return: maximum number of records per file
+    """
+    record_bytes = max(1, df._jdf.schema().defaultSize())
+    return max(1, target_file_bytes * PARQUET_COMPRESSION_RATIO // record_bytes)
+
+
+def partition_buckets(df, partition_by, target_file_bytes=TARGET_FILE_BYTES):
+    """
+    Estimates how many tasks should write each partition of a partitioned dataset, so a large partition
+    is split across tasks instead of being written (and sorted) by a single one.
+    The estimated size of the dataframe is spread evenly over its partitions, which are counted
+    only when the dataframe needs more than one file.
+    :param df: dataframe to be written
+    :param partition_by: list of partition columns
+    :param target_file_bytes: target size of the files
+    :return: number of buckets per partition, at most spark.sql.shuffle.partitions
+    """
+    num_files = int(math.ceil(estimated_size(df) / float(target_file_bytes * PARQUET_COMPRESSION_RATIO)))
+    if num_files <= 1:
+        return 1
+    num_partitions = max(1, df.select(*partition_by).distinct().count())
+    max_buckets = int(df._jdf.sparkSession().conf().get('spark.sql.shuffle.partitions'))
+    return max(1, min(int(math.ceil(num_files / float(num_partitions))), max_buckets))
+
+
+def parquet_writer(df, mode='overwrite', target_file_bytes=TARGET_FILE_BYTES, row_group_bytes=ROW_GROUP_BYTES,
+                   codec=PARQUET_CODEC):
+    """
+    Creates the writer of a dataframe with the file size, row group size and codec of the output datasets.
+    :param df: dataframe to be written
+    :param mode: save mode
+    :param target_file_bytes: target size of the files
+    :param row_group_bytes: size of the Parquet row groups
+    :param codec: Parquet compression codec
+    :return: DataFrameWriter
+    """
+    return df.write \
+        .mode(mode) \
+        .option('maxRecordsPerFile', records_per_file(df, target_file_bytes)) \
+        .option('compression', codec) \
+        .option('parquet.block.size', row_group_bytes)
+
+
+def write_table(df, path, partition_by=None, mode='overwrite', target_file_bytes=TARGET_FILE_BYTES,
+                sort_by=None, row_group_bytes=ROW_GROUP_BYTES, codec=PARQUET_CODEC):
+    """
+    Writes an output dataset in Parquet format with files close to the target size.
+    Partitioned datasets are repartitioned by the partition columns and a bucket computed from a hash of the row
+    (see partition_buckets), so each partition directory is written by as many tasks as its estimated size requires,
+    and the number of records per file is capped to split large partitions further.
+    Unpartitioned datasets are repartitioned to the number of files their estimated size requires.
+    Rows can be sorted within each partition, so the min/max statistics of the row groups
+    let readers skip the row groups that do not match a filter on the sort columns.
+    :param df: dataframe to be written
+    :param path: path to the Parquet dataset
+    :param partition_by: list of partition columns
+    :param mode: save mode
+    :param target_file_bytes: target size of the files
+    :param sort_by: list of columns used to sort the rows within each partition
+    :param row_group_bytes: size of the Parquet row groups
+    :param codec: Parquet compression codec
+    :return: None
+    """
+    if partition_by:
+        buckets = partition_buckets(df, partition_by, target_file_bytes)
+        if buckets > 1:
+            df = df.repartition(*(list(partition_by) + [pmod(hash_(*df.columns), lit(buckets))]))
+        else:
+            df = df.repartition(*partition_by)
+    else:
+        num_files = int(math.ceil(estimated_size(df) / float(target_file_bytes * PARQUET_COMPRESSION_RATIO)))
+        df = df.repartition(max(1, num_files))
+
+    if sort_by:
+        df = df.sortWithinPartitions(*((partition_by or []) + sort_by))
+
+    writer = parquet_writer(df, mode, target_file_bytes, row_group_bytes, codec)
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    capture_plan(df, path.rstrip('/').rsplit('/', 1)[-1])
+    writer.parquet(path)
+
+
+def java_value(value):
+    """
+    Converts a value of the Parquet statistics returned by py4j to a python value.
+    :param value: int, float, bool or Parquet Binary
+    :return: python value
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return value.toStringUsingUTF8()
+
+
+def parquet_file_statistics(spark, file_path, columns):
+    """
+    Reads the row group statistics of a Parquet file from its footer.
+    :param spark: spark session
+    :param file_path: path to the Parquet file
+    :param columns: names of the columns whose min/max are returned
+    :return: list with one dict per row group: {'rows': number of rows, 'min_max': {column: [min, max]}}
+    """
+    jvm = spark.sparkContext._jvm
+    footer = jvm.org.apache.parquet.hadoop.ParquetFileReader.readFooter(
+        spark.sparkContext._jsc.hadoopConfiguration(), jvm.org.apache.hadoop.fs.Path(file_path))
+
+    row_groups = []
+    for block in footer.getBlocks():
+        min_max = {}
+        for chunk in block.getColumns():
+            name = chunk.getPath().toDotString()
+            stats = chunk.getStatistics()
+            if name in columns and stats is not None and stats.hasNonNullValue():
+                min_max[name] = [java_value(stats.genericGetMin()), java_value(stats.genericGetMax())]
+        row_groups.append({'rows': block.getRowCount(), 'min_max': min_max})
+    return row_groups
+
+
+def record_file_statistics(spark, path, columns, directories=None):
+    """
+    Saves the row group statistics of every Parquet file of a dataset in a FILE_STATS_NAME file
+    in each partition directory.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param columns: names of the columns whose min/max are recorded
+    :param directories: partition directories to be processed (all of them when None)
+    :return: None
+    """
+    if not columns or not path_exists(spark, path):
+        return
+    for directory in directories or partition_directories(spark, path):
+        files = [f for f in list_directory(spark, directory)[0] if f.path.endswith('.parquet')]
+        stats = [{'path': f.path, 'size': f.size, 'row_groups': parquet_file_statistics(spark, f.path, columns)}
+                 for f in files]
+        write_text(spark, directory.rstrip('/') + '/' + FILE_STATS_NAME, json.dumps(stats))
+
+
+def read_existing(spark, path):
+    """
+    Reads an output dataset written by a previous run.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :return: dataframe or None if the dataset does not exist or has no data files
+    """
+    if not path_exists(spark, path):
+        return None
+    try:
+        return spark.read.parquet(path)
+    except AnalysisException:
+        # the previous run wrote an empty dataset
+        return None
+
+
+def partition_filter(partitions, partition_by):
+    """
+    Builds a static filter that selects the given partitions, so only their directories are read.
+    :param partitions: rows with the values of the partition columns
+    :param partition_by: list of partition columns
+    :return: boolean column
+    """
+    selected = lit(False)
+    for p in partitions:
+        cond = lit(True)
+        for c in partition_by:
+            cond = cond & (col(c) == p[c])
+        selected = selected | cond
+    return selected
+
+
+def partition_subpath(partition, partition_by):
+    """
+    Returns the directory of a partition relative to the dataset path (e.g. year=2018/month=11).
+    :param partition: row with the values of the partition columns
+    :param partition_by: list of partition columns
+    :return: relative path
+    """
+    return '/'.join('{}={}'.format(c, partition[c]) for c in partition_by)
+
+
+def restore_trash(spark, path, partition_by):
+    """
+    Cleans up after an upsert that stopped while swapping partitions (see upsert_partitions):
+    the partitions left in the _trash directory that are missing from the dataset are moved back,
+    and the old versions of the partitions that were already replaced are deleted.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param partition_by: list of partition columns
+    :return: list of paths to the partition directories restored
+    """
+    path = path.rstrip('/')
+    trash_path = path + '/_trash'
+    if not path_exists(spark, trash_path):
+        return []
+
+    restored = []
+    for directory in partition_directories(spark, trash_path):
+        names = directory.rstrip('/').split('/')[-len(partition_by):]
+        if [n.split('=', 1)[0] for n in names] != list(partition_by):
+            # empty _trash directory
+            continue
+        subpath = '/'.join(names)
+        target = path + '/' + subpath
+        if not path_exists(spark, target):
+            make_parent_dirs(spark, target)
+            move_path(spark, directory, target)
+            restored.append(target)
+            logger.warning('Restored partition %s of %s left by an interrupted upsert', subpath, path)
+    delete_path(spark, trash_path)
+    return restored
+
+
+def upsert_partitions(spark, df, path, partition_by, key_columns, sort_by=None, stats_columns=None):
+    """
+    Merges rows into the partitions of a partitioned Parquet dataset that receive them.
+    In each affected partition, the existing rows with the same key as a new row are replaced by the new row
+    and the other existing rows are kept. The merged partitions are written to a staging directory and then
+    swapped with the current ones: each current partition is moved to a _trash directory and its new version
+    is moved in its place. The swap is not atomic: a reader listing the dataset between the two moves does not
+    see the partition, and on S3 each move copies and deletes the files, so the dataset must not be read
+    while it is upserted. If the job stops between the two moves, the next upsert restores the old version
+    from _trash first (see restore_trash). All the other partitions are not touched.
+    :param spark: spark session
+    :param df: new or changed rows
+    :param path: path to the Parquet dataset
+    :param partition_by: list of partition columns
+    :param key_columns: columns that identify a row
+    :param sort_by: list of columns used to sort the rows within each partition
+    :param stats_columns: if given, the statistics of these columns are recorded for the new partitions
+    :return: list of paths to the partition directories rewritten
+    """
+    restore_trash(spark, path, partition_by)
+    df = df.dropDuplicates(key_columns)
+    partitions = df.select(*partition_by).distinct().collect()
+    if not partitions:
+        return []
+
+    existing = read_existing(spark, path)
+    if existing is not None:
+        kept = existing.filter(partition_filter(partitions, partition_by)).join(df, key_columns, 'left_anti')
+        df = kept.unionByName(df)
+
+    path = path.rstrip('/')
+    staging_path = path + '_staging'
+    write_table(df, staging_path, partition_by, sort_by=sort_by)
+
+    for p in partitions:
+        subpath = partition_subpath(p, partition_by)
+        target = path + '/' + subpath
+        trash = path + '/_trash/' + subpath
+        if path_exists(spark, target):
+            delete_path(spark, trash)
+            make_parent_dirs(spark, trash)
+            move_path(spark, target, trash)
+        make_parent_dirs(spark, target)
+        move_path(spark, staging_path + '/' + subpath, target)
+
+    delete_path(spark, path + '/_trash')
+    delete_path(spark, staging_path)
+
+    directories = [path + '/' + partition_subpath(p, partition_by) for p in partitions]
+    if stats_columns:
+        record_file_statistics(spark, path, stats_columns, directories)
+    logger.info('Upserted %d partitions of %s', len(partitions), path)
+    return directories
+
+
+def append_new_rows(spark, df, path):
+    """
+    Appends to a Parquet dataset only the rows it does not contain yet.
+    :param spark: spark session
+    :param df: rows to be merged into the dataset
+    :param path: path to the Parquet dataset
+    :return: None
+    """
+    existing = read_existing(spark, path)
+    if existing is not None:
+        df = df.join(existing, [df[c].eqNullSafe(existing[c]) for c in df.columns], 'left_anti')
+
+    write_table(df, path, mode='append')
+
+
+def partition_directories(spark, path):
+    """
+    Finds the leaf directories (the ones holding the data files) of a Parquet dataset.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :return: list of paths
+    """
+    _, directories = list_directory(spark, path)
+    if not directories:
+        return [path]
+
+    leaves = []
+    for d in directories:
+        leaves.extend(partition_directories(spark, d))
+    return leaves
+
+
+def compact_directory(spark, directory, sort_by=None, target_file_bytes=TARGET_FILE_BYTES,
+                      row_group_bytes=ROW_GROUP_BYTES, codec=PARQUET_CODEC):
+    """
+    Rewrites the Parquet files of a partition directory into as few files of the target size as possible,
+    with the same sort, row group size and codec as write_table, so the row group statistics stay selective.
+    The new files are written to a hidden directory, moved next to the old files and then the old files are deleted.
+    Readers running at the same time may see duplicated rows, so this must run while the dataset is not used.
+    :param spark: spark session
+    :param directory: path to the partition directory
+    :param sort_by: list of columns used to sort the rows of each file
+    :param target_file_bytes: target size of the files
+    :param row_group_bytes: size of the Parquet row groups
+    :param codec: Parquet compression codec
+    :return: True if the directory was compacted
+    """
+    files = [f for f in list_directory(spark, directory)[0] if f.path.endswith('.parquet')]
+    total_bytes = sum(f.size for f in files)
+    num_files = max(1, int(math.ceil(total_bytes / float(target_file_bytes))))
+
+    if len(files) <= num_files or total_bytes / len(files) >= SMALL_FILE_BYTES:
+        return False
+
+    tmp_path = directory.rstrip('/') + '/_compacting'
+    df = spark.read.parquet(*[f.path for f in files]).coalesce(num_files)
+    if sort_by:
+        df = df.sortWithinPartitions(*sort_by)
+    parquet_writer(df, 'overwrite', target_file_bytes, row_group_bytes, codec).parquet(tmp_path)
+
+    for f in list_directory(spark, tmp_path)[0]:
+        if f.path.endswith('.parquet'):
+            move_path(spark, f.path, directory.rstrip('/') + '/' + f.path.rsplit('/', 1)[1])
+    for f in files:
+        delete_path(spark, f.path)
+    delete_path(spark, tmp_path)
+
+    logger.info('Compacted %s: %d files -> %d files (%d bytes)', directory, len(files), num_files, total_bytes)
+    return True
+
+
+def compact_dataset(spark, path, table=None, target_file_bytes=TARGET_FILE_BYTES):
+    """
+    Compacts every partition of a Parquet dataset that holds many small files.
+    :param spark: spark session
+    :param path: path to the Parquet dataset
+    :param table: etl.OutputTable of the dataset, whose sort is kept in the compacted files
+    :param target_file_bytes: target size of the files
+    :return: number of partitions compacted
+    """
+    if not path_exists(spark, path):
+        return 0
+
+    sort_by = table.sort_by if table else None
+    compacted = 0
+    for directory in partition_directories(spark, path):
+        if compact_directory(spark, directory, sort_by, target_file_bytes):
+            compacted += 1
+
+    logger.info('Compacted %d partitions of %s', compacted, path)
+    return compacted